@@ -50,9 +50,17 @@ class Breakpoint(object):
         }
 
 class LineBreakpoint(Breakpoint):
-    """Simple breakpoint that breaks if in file at line"""
-    def __init__(self, file, line, temporary=False):
+    """Simple breakpoint that breaks if in file at line
+
+    condition, ignore and every are evaluated by the debugger backend,
+    with a template ('x={x}') it is a logpoint: it logs and never stops"""
+    def __init__(self, file, line, temporary=False, condition=None,
+                 ignore=0, every=0, template=None):
         self.line = line
+        self.condition = condition
+        self.ignore = ignore
+        self.every = every
+        self.template = template
         super(LineBreakpoint, self).__init__(file, temporary)
 
     def breaks(self, frame):
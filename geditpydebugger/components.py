@@ -3,9 +3,10 @@ import os
 import qdb
 
 from .console import ConsoleWidget
+from .variables import VariablesModel
 from .image_utils import get_giofileicon_from_file, get_pixbuf_from_file, \
     DEBUG_ICON, STEP_INTO_ICON, STEP_OUT_ICON, STEP_OVER_ICON, STOP_ICON, \
-    STEP_CONTINUE_ICON, VARIABLE_ICON, BREAKPOINT_PIXBUF
+    STEP_CONTINUE_ICON, BREAKPOINT_PIXBUF
 
 MODULE_DIRECTORY = os.path.dirname(__file__)
 
@@ -38,7 +39,7 @@ class InterpretersDialog:
 
 class ContextBox(Gtk.HPaned):
 
-    def __init__(self, main_gui):
+    def __init__(self, main_gui, scrollback_lines=None):
         Gtk.HPaned.__init__(self)
         self.main_gui = main_gui
 
@@ -48,12 +49,20 @@ class ContextBox(Gtk.HPaned):
 
         self._context_notebook = builder.get_object("context_notebook")
         self._console_box = builder.get_object("leftbox")
-        self._console = ConsoleWidget(self.main_gui)
+        self._console = ConsoleWidget(self.main_gui, scrollback_lines)
         self._console_box.pack_start(self._console, True, True, 0)
 
-        self._variables_treestore = builder.get_object("variables_treestore")
+        # rows are materialized when shown, children loaded when expanded
+        self._variables_model = VariablesModel()
+        self._variables_view = builder.get_object("treeview1")
+        self._variables_view.set_model(self._variables_model)
         self._callstack_list_store = builder.get_object("callstack_list_store")
         self._breakpoints_liststore = builder.get_object("breakpoints_liststore")
+        self._scopes_version = None     # locals version shown (see update_context)
+        self._inspecting = {}   # (handle, start): version when requested
+        self._expand = []       # handles to expand again once loaded
+        self._variables_view.connect("key-press-event",
+                                     self.on_variables_key_press)
 
         self.debug_action = builder.get_object("debug_action")
         self.debug_action.set_gicon(get_giofileicon_from_file(DEBUG_ICON))
@@ -73,6 +82,8 @@ class ContextBox(Gtk.HPaned):
         self.step_stop_action = builder.get_object("step_stop_action")
         self.step_stop_action.set_gicon(get_giofileicon_from_file(STOP_ICON))
 
+        self.restart_action = builder.get_object("restart_action")
+
         self.pack1(self._console_box, True, False)
         self.pack2(self._context_notebook, True, True)
 
@@ -83,6 +94,7 @@ class ContextBox(Gtk.HPaned):
         self.step_out_action.set_sensitive(val)
         self.step_continue_action.set_sensitive(val)
         self.step_stop_action.set_sensitive(val)
+        self.restart_action.set_sensitive(val)
         while Gtk.events_pending():
             Gtk.main_iteration_do(False)
 
@@ -92,6 +104,9 @@ class ContextBox(Gtk.HPaned):
     def stop_cb(self, widget):
         self.main_gui.stop_cb()
 
+    def restart_cb(self, widget):
+        self.main_gui.restart_cb()
+
     def step_into_cb(self, widget):
         self.main_gui.step_into_cb()
 
@@ -111,24 +126,87 @@ class ContextBox(Gtk.HPaned):
         print(bk.file, bk.line)
 
     def clear(self):
-        self._variables_treestore.clear()
+        self._variables_model.clear()
         self._callstack_list_store.clear()
+        self._inspecting.clear()
+        self._expand = []
 
     def set_context(self, context):
         self.BuildCallStackList(context["call_stack"])
-        self._variables_treestore.clear()
-        globals_it = self._variables_treestore.append(None, [get_pixbuf_from_file(VARIABLE_ICON),
-                                                          "Globals", "Global variables"])
-        for g in context['environment']['globals'].keys():
-            val, vtype = context['environment']['globals'][g]
-            it = self._variables_treestore.append(globals_it, [get_pixbuf_from_file(VARIABLE_ICON),
-                                                            g, vtype + ': ' + val])
-
-        # now add locals
-        for k in context['environment']['locals'].keys():
-            val, vtype = context['environment']['locals'][k]
-            it = self._variables_treestore.append(None, [get_pixbuf_from_file(VARIABLE_ICON),
-                                                      k, vtype + ': ' + val])
+        self.update_context(context)
+
+    def update_context(self, context):
+        scopes = context.get('scopes')
+        if not scopes:
+            return
+        local = scopes[0]
+        if 'base' in local and local['base'] != self._scopes_version:
+            # the diff doesn't apply to the rows shown: get the whole context
+            # (set when it comes)
+            self.main_gui.do_refresh()
+            return
+        self._scopes_version = local['version']
+        if 'base' in local:
+            model = self._variables_model
+            # the expanded rows are reloaded: expand them again (by handle,
+            # the parents first, as their children are loaded)
+            expanded = []
+            self._variables_view.map_expanded_rows(
+                lambda view, path: expanded.append(
+                    model.get_row(model.get_iter(path)).handle))
+            model.patch_locals(local)
+            self._expand = expanded
+            self._expand_rows()
+        else:
+            self._expand = []
+            self._variables_model.set_scopes(scopes)
+
+    def _expand_rows(self):
+        "Expand the rows to expand again that are shown (loading them)"
+        model = self._variables_model
+        for handle in list(self._expand):
+            it = model.find(handle)
+            if it is not None:
+                self._expand.remove(handle)
+                self._variables_view.expand_row(model.get_path(it), False)
+
+    def on_variables_test_expand_row(self, treeview, it, path):
+        model = self._variables_model
+        row = model.get_row(it)
+        if row.start < 0 and row.children is not None:
+            return False    # already loaded
+        key = (row.handle, max(row.start, 0))
+        if key not in self._inspecting and self.main_gui.do_inspect(*key):
+            # expanded when the page comes (see inspect_done)
+            self._inspecting[key] = self._scopes_version
+        return True
+
+    def inspect_done(self, handle, start, page):
+        "A page of children came: show it, if the variables didn't change"
+        key = (handle, start)
+        if key not in self._inspecting or \
+           self._inspecting.pop(key) != self._scopes_version or not page:
+            return      # i.e. stepped meanwhile, or cancelled
+        model = self._variables_model
+        if start:
+            # "more..." row: load the next page in its place
+            more = model.find_more(handle, start)
+            if more is not None:
+                model.add_page(more.parent, page, more)
+                model.remove(more)
+            return
+        it = model.find(handle)
+        if it is None or model.get_row(it).children is not None:
+            return
+        model.add_page(model.get_row(it), page)
+        self._variables_view.expand_row(model.get_path(it), False)
+        self._expand_rows()
+
+    def on_variables_key_press(self, treeview, event):
+        if event.keyval == Gdk.KEY_Escape:
+            # stop receiving the variables (big responses are streamed)
+            self.main_gui.cancel_transfers()
+        return False
 
     def add_breakpoint(self, bk):
         self._breakpoints_liststore.append([True, str(bk.file) + ':' + str(bk.line),
@@ -153,3 +231,6 @@ class ContextBox(Gtk.HPaned):
     def write_stdout(self, msg):
         self._console.writeToOutputBuffer(msg)
         return
+
+    def exec_done(self, result):
+        self._console.execDone(result)
@@ -1,4 +1,7 @@
-from gi.repository import Gtk, Gdk, Pango
+from gi.repository import Gtk, Gdk, GLib, Pango
+
+# lines kept in the output (the oldest are removed)
+MAX_LINES = 10000
 
 
 class ConsoleWidget(Gtk.VBox):
@@ -8,7 +11,7 @@ class ConsoleWidget(Gtk.VBox):
     @author: Pedro Guridi <pedro.guridi@gmail.com>
     '''
 
-    def __init__(self, maingui):
+    def __init__(self, maingui, max_lines=None):
         Gtk.VBox.__init__(self)
         #self.set_default_size (680, 400)
         self.set_border_width(3)
@@ -19,6 +22,12 @@ class ConsoleWidget(Gtk.VBox):
         self._lastCommand = ""
         self._lastReturn = ""
 
+        # output is buffered and written once per frame (see _flush)
+        self.max_lines = max_lines or MAX_LINES
+        self._pending = []
+        self._pending_lines = 0
+        self._flush_id = None
+
         # Setup text view
         self.text = Gtk.TextView()
         self.text.set_property('can-focus', False)
@@ -38,6 +47,8 @@ class ConsoleWidget(Gtk.VBox):
         self.buffer = self.text.get_buffer()
         self.buffer.create_tag('bold', \
                                weight=Pango.Weight.BOLD, editable=False)
+        # (right gravity: stays at the end when text is appended)
+        self._end_mark = self.buffer.create_mark("eot", self.buffer.get_end_iter(), False)
 
         self._promptHbox = Gtk.HBox()
         self.promptTextview = Gtk.TextView()
@@ -83,6 +94,7 @@ class ConsoleWidget(Gtk.VBox):
 
         #self._running = False
         self._closing = False
+        self._executing = False     # waiting for a statement (see Execute)
 
         self._prompt()
 
@@ -116,19 +128,38 @@ class ConsoleWidget(Gtk.VBox):
         self.writeToPrompt(self.promptString)
 
     def Execute(self, cmd):
+        if self._executing:
+            self.writeToOutputBuffer("*** busy (Ctrl+C to interrupt)\n")
+            return
         try:
             res = self.main_gui.do_exec(cmd)
-            if res != 'None':
+            if res is True:
+                # the result will come later (see execDone)
+                self._executing = True
+                self.promptTextview.set_cursor_visible(False)
+            elif res is not None:
                 self.writeToOutputBuffer(res + "\n")
         except Exception as e:
             print("invalid cmd")
             print(e)
 
+    def execDone(self, res):
+        """ Show the result of the statement executed """
+        self._executing = False
+        self.promptTextview.set_cursor_visible(True)
+        if res is not None:
+            self.writeToOutputBuffer(res + "\n")
+
     def onKeyPressed(self, widget, event, textView, buffer, promptTextView, promptBuffer):
         """ Key pressed handler """
         #if self._running:
         #	return True
         key_name = str(Gdk.keyval_name(event.keyval))
+        if self._executing and key_name.lower() == "c" and \
+           event.state & Gdk.ModifierType.CONTROL_MASK:
+            self.writeToOutputBuffer("*** interrupting...\n")
+            self.main_gui.cancel_exec()
+            return True
         if key_name == "Left":
             it = self.promptBuffer.get_iter_at_mark(self.promptBuffer.get_insert())
             tagTable = self.promptBuffer.get_tag_table()
@@ -210,24 +241,53 @@ class ConsoleWidget(Gtk.VBox):
         self.promptBuffer.place_cursor(self.promptBuffer.get_end_iter())
 
     def writeToOutputBuffer(self, line):
-        """ Write text to the output buffer """
+        """ Write text to the output buffer (at the next frame) """
         if line[:3] == "#@*":
             code, command, status = line.split("&")
             if status.strip() == "finished":
-                self.scrollToEnd()
+                self._flush()
                 #self._running = False
                 self.scrollToEnd()
                 self.promptTextview.set_cursor_visible(True)
                 self._lastCommand = ""
                 self._lastReturn = ""
             return
-        end = self.buffer.get_end_iter()
-
-        #if line != "":
-        self._lastReturn += line
-        self.buffer.insert(end, line)
-
-    #self.buffer.insert(end, unicode(line))
+        self._pending.append(line)
+        self._pending_lines += line.count("\n")
+        if self._pending_lines > self.max_lines:
+            # no frame for a while (i.e. hidden): don't keep more than shown
+            self._flush()
+        elif self._flush_id is None:
+            if self.text.get_mapped():
+                self._flush_id = self.text.add_tick_callback(self._on_tick)
+            else:
+                self._flush_id = GLib.idle_add(self._flush, priority=GLib.PRIORITY_LOW)
+
+    def _on_tick(self, widget, frame_clock):
+        self._flush()
+        return False
+
+    def _flush(self):
+        """ Write the pending output in one insert, and trim the oldest lines """
+        self._flush_id = None
+        if not self._pending or self._closing:
+            return False
+        text = "".join(self._pending)
+        self._pending = []
+        self._pending_lines = 0
+        lines = text.split("\n")
+        if len(lines) > self.max_lines:
+            text = "\n".join(lines[-self.max_lines:])
+        # follow the output only if it was shown up to the end
+        adj = self.scrollWin.get_vadjustment()
+        at_end = adj.get_value() >= adj.get_upper() - adj.get_page_size() - 1
+        self.buffer.insert(self.buffer.get_end_iter(), text)
+        extra = self.buffer.get_line_count() - self.max_lines
+        if extra > 0:
+            self.buffer.delete(self.buffer.get_start_iter(), self.buffer.get_iter_at_line(extra))
+        if at_end:
+            self.scrollToEnd()
+        return False
 
     def writeToPrompt(self, line):
         """ Write text to the prompt """
@@ -237,6 +297,7 @@ class ConsoleWidget(Gtk.VBox):
 
     def writeToOutputBold(self, line):
         """ Write bold text to the output """
+        self._flush()
         start, end = self.buffer.get_bounds()
         self.buffer.insert_with_tags_by_name(end, line, "bold")
         self.scrollToEnd()
@@ -246,12 +307,13 @@ class ConsoleWidget(Gtk.VBox):
     def scrollToEnd(self):
         if self._closing:
             return
-        it = self.buffer.get_iter_at_line(self.buffer.get_line_count() - 1)
-        tmark = self.buffer.create_mark("eot", it, False)
-        self.text.scroll_to_mark(tmark, 0, False, 0, 0)
+        self.buffer.move_mark(self._end_mark, self.buffer.get_end_iter())
+        self.text.scroll_to_mark(self._end_mark, 0, False, 0, 0)
 
     def _clear(self):
         """ Clears the output buffer"""
+        self._pending = []
+        self._pending_lines = 0
         self.buffer.set_text('\n')
         self.scrollToEnd()
 
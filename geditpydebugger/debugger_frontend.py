@@ -1,8 +1,10 @@
-from json_serializer import JsonClient
-from multiprocessing import Queue
+from json_serializer import JsonClient, COMPRESS_THRESHOLD
+from collections import deque
 
 import os
-import time
+import selectors
+import socket
+import subprocess
 
 import sys
 
@@ -16,6 +18,160 @@ from qdb import Frontend
 from .breakpoint import LineBreakpoint
 
 
+def launch(argv, cwd=None, address=None, env=None):
+    """Start a debugger backend (argv: interpreter, launcher and script) and
+    return the process and the address to attach to, once it is ready:
+    one end of a private socketpair by default (ready at once), or the
+    endpoint of a listener ('unix:' or 'HOST:PORT'), reported thru a pipe"""
+    env = dict(os.environ, **(env or {}))
+    if address is None:
+        ours, theirs = socket.socketpair()
+        env["QDB_ADDRESS"] = "fd:%d" % theirs.fileno()
+        try:
+            proc = subprocess.Popen(argv, cwd=cwd, env=env, close_fds=True,
+                                    pass_fds=(theirs.fileno(), ))
+        except Exception:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        return proc, "fd:%d" % ours.detach()
+    ready_r, ready_w = os.pipe()
+    env["QDB_ADDRESS"] = address
+    env["QDB_READY_FD"] = str(ready_w)
+    try:
+        proc = subprocess.Popen(argv, cwd=cwd, env=env, close_fds=True,
+                                pass_fds=(ready_w, ))
+    finally:
+        os.close(ready_w)
+    with os.fdopen(ready_r, "rb") as ready:
+        # blocks until the backend is listening (EOF if it failed to start)
+        line = ready.readline().decode("utf-8").strip()
+    if not line:
+        raise RuntimeError("Debugger backend failed to start (exit code %s)"
+                           % proc.wait())
+    return proc, line
+
+
+class ForkServer(object):
+    """Warm process that forks a debug session per run (see qdb_forkserver):
+    the preloaded modules are imported once, not on every (re)start"""
+
+    def __init__(self, argv, cwd=None, preload=()):
+        env = {"QDB_PRELOAD": ",".join(preload)}
+        self.proc, address = launch(argv, cwd=cwd, env=env)
+        self.conn = JsonClient(address)
+        self.i = 1
+
+    def call(self, method, *args):
+        self.conn.send({'method': method, 'args': args, 'id': self.i})
+        self.i += 1
+        res = self.conn.recv()
+        if res.get('error'):
+            raise qdb.RPCError(res['error']['message'])
+        return res['result']
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def run(self, script, args=(), cwd=None):
+        "Start a debug session, return its pid and address (ready to attach)"
+        pid, address = self.call('run', script, list(args), cwd)
+        return pid, address
+
+    def kill(self, pid):
+        "Terminate a debug session"
+        self.call('kill', pid)
+
+    def close(self):
+        try:
+            self.call('quit')
+        except (EOFError, IOError):
+            pass
+        self.conn.close()
+        self.proc.wait()
+
+
+def _full_context(context):
+    "True if the context replaces the locals shown (not a diff of them)"
+    scopes = context.get('scopes')
+    return bool(scopes) and 'base' not in scopes[0]
+
+
+class EventChannel(object):
+    """In process queue of GUI events (posted by the debugger threads):
+    the consumer is woken up when the first event arrives, then takes them
+    in batches, coalesced, until none is left (see done)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = deque()
+        self._scheduled = False     # the consumer will call take again
+
+    def put(self, event, args):
+        "Queue an event, return True if the consumer must be woken up"
+        with self._lock:
+            self._events.append((event, args))
+            if self._scheduled:
+                return False
+            self._scheduled = True
+            return True
+
+    def take(self):
+        "Return the events queued (coalesced, in order) and empty the queue"
+        with self._lock:
+            events, self._events = self._events, deque()
+        return self.coalesce(events)
+
+    def done(self):
+        "The consumer has no events left: return False if more arrived"
+        with self._lock:
+            if self._events:
+                return False
+            self._scheduled = False
+            return True
+
+    def coalesce(self, events):
+        """Drop the events superseded by later ones: only the last stop is
+        marked (the previous ones just apply their variable diffs, unless a
+        later context replaces them), repeated clears, old progress; and
+        join consecutive writes"""
+        kept = []
+        mark_later = full_later = False
+        progress_later = set()
+        for event, args in reversed(events):
+            if event == 'mark-current-line' and mark_later:
+                event, args = 'update-context', (args[2], )
+            if event == 'mark-current-line':
+                mark_later = True
+                full_later = full_later or _full_context(args[2])
+            elif event == 'update-context':
+                if full_later:
+                    continue
+                full_later = _full_context(args[0])
+            elif event == 'clear-interaction':
+                if kept and kept[-1][0] == event:
+                    continue
+            elif event == 'progress':
+                if args[0] in progress_later:
+                    continue
+                progress_later.add(args[0])
+            kept.append((event, args))
+        kept.reverse()
+        result, texts = deque(), []
+        for event, args in kept:
+            if event == 'write':
+                texts.append(args[0])
+                continue
+            if texts:
+                result.append(('write', (''.join(texts), )))
+                texts = []
+            result.append((event, args))
+        if texts:
+            result.append(('write', (''.join(texts), )))
+        return result
+
+
 class LoggingPipeWrapper:
 
     def __init__(self, pipe):
@@ -33,16 +189,46 @@ class LoggingPipeWrapper:
     def close(self):
         self.__pipe.close()
 
-    def poll(self):
-        return self.__pipe.poll()
+    def poll(self, timeout=0.0):
+        return self.__pipe.poll(timeout)
+
+    def fileno(self):
+        return self.__pipe.fileno()
+
+    @property
+    def codecs(self):
+        return getattr(self.__pipe, 'codecs', ())
+
+    def accept_codec(self, name):
+        self.__pipe.accept_codec(name)
+
+    def set_codec(self, name):
+        self.__pipe.set_codec(name)
+
+    @property
+    def compressions(self):
+        return getattr(self.__pipe, 'compressions', ())
+
+    def accept_compression(self):
+        self.__pipe.accept_compression()
+
+    def set_compression(self, threshold):
+        self.__pipe.set_compression(threshold)
+
+    @property
+    def stats(self):
+        return getattr(self.__pipe, 'stats', {})
 
 
 class CallbackFrontend(Frontend):
     "A callback driven Frontend interface to qdb"
 
-    def __init__(self, pipe=None, breakpoints=None):
+    def __init__(self, pipe=None, breakpoints=None, compress_threshold=None):
         Frontend.__init__(self, pipe)
-        self.messages_queue = Queue()
+        self.events = EventChannel()
+        self.notify = None          # called when the GUI must take events
+        # compress messages bigger than this (default: only remote links)
+        self.compress_threshold = compress_threshold
         if breakpoints:
             self._breakpoints = breakpoints
         else:
@@ -54,11 +240,23 @@ class CallbackFrontend(Frontend):
         self.post_event = True      # send event to the GUI
         self.start_continue = True  # continue on first run
         self.rawinput = None
+        self._exec_future = None    # console statement being executed
+        self._deferred = []         # calls to send when it ends (see below)
+        self._deferred_lock = threading.Lock()
+        self._transfers = set()     # Inspect / Refresh calls in flight
+        self._quiet_calls = 0       # interaction notifications to ignore
+        self._quiet_lock = threading.Lock()
         self.filename = self.lineno = None
         self.unrecoverable_error = False
         self.pipe = None
+        # the reader thread blocks until attached, then until data arrives
+        # (or the wakeup pipe is written, to stop it when detaching)
+        self._attached_event = threading.Event()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._wakeup_lock = threading.Lock()    # detach vs closing it
 
         t = threading.Thread(target=self._run)
+        t.daemon = True
         t.start()
 
     """
@@ -74,15 +272,46 @@ class CallbackFrontend(Frontend):
     def startup(self):
         "Initialization procedures (called by the backend)"
         # notification sent by _runscript before Bdb.run
-        self.LoadBreakpoints()
+        if not self.is_remote():
+            # (marshal must not decode data from hosts that are not trusted)
+            self.negotiate_codec()
+        threshold = self.compress_threshold
+        if threshold is None and self.is_remote():
+            threshold = COMPRESS_THRESHOLD
+        if threshold is not None:
+            self.negotiate_compression(threshold)
+        # breakpoints and parameters in a single message (one round trip)
+        batch = self.new_batch()
+        self._add_breakpoints(batch)
         print("enabling call_stack and environment at interaction")
-        self.set_params(dict(call_stack=True, environment=True, postmortem=True))
+        # just my code: do not step into the standard library / site-packages
+        # variables are sent by handle, children are inspected on demand
+        batch.add('set_params', dict(call_stack=True, scopes=True,
+                                     postmortem=True, just_my_code=True))
+        for err in batch.send():
+            if err:
+                print("Breakpoint not set: %s" % err)
         # return control to the backend:
         Frontend.startup(self)
 
+    def _post(self, event, args):
+        "Queue an event for the GUI and wake it up (if not already)"
+        if self.events.put(event, args) and self.notify:
+            self.notify()
+
     def write(self, text):
         "ouputs a message (called by the backend)"
-        self.messages_queue.put(("write", (text,)))
+        self._post("write", (text,))
+
+    def log(self, messages):
+        "outputs a batch of logpoint messages (called by the backend)"
+        text = "".join("%s:%s: %s\n" % (os.path.basename(filename), lineno, msg)
+                       for filename, lineno, msg in messages)
+        self._post("write", (text,))
+
+    def progress(self, id, received, total):
+        "a big response is being received (called by the reader)"
+        self._post("progress", (id, received, total))
 
     def readline(self):
         "returns a user input (called by the backend)"
@@ -108,12 +337,20 @@ class CallbackFrontend(Frontend):
                 self.filename = filename
                 self.orig_line = line.strip().strip("\r").strip("\n")
                 self.lineno = lineno
-                if self.post_event:
+                with self._quiet_lock:
+                    quiet = self._quiet_calls
+                    if quiet:
+                        self._quiet_calls -= 1
+                if self.post_event and not quiet:
                     # send the event to mark the current line
-                    self.messages_queue.put(("mark-current-line", (filename, lineno, context)))
+                    self._post("mark-current-line", (filename, lineno, context))
                 else:
                     # ignore this (async command) and reenable notifications
-                    self.post_event = True
+                    if not quiet:
+                        self.post_event = True
+                    # the variables could be changed (i.e. exec), and the
+                    # diffs must be applied in order: update them anyway
+                    self._post("update-context", (context,))
         finally:
             pass
 
@@ -123,12 +360,17 @@ class CallbackFrontend(Frontend):
     """
     def _run(self):
         "Debugger main loop: read and execute remote methods"
+        self._attached_event.wait()
+        selector = selectors.DefaultSelector()
         try:
-            while True:
-                if self.attached and self.pipe:
-                    time.sleep(0.01)
-                    while self.pipe.poll():
-                        self.run()
+            selector.register(self.pipe.fileno(), selectors.EVENT_READ)
+            selector.register(self._wakeup_r, selectors.EVENT_READ)
+            while self.attached:
+                # sleep until a message arrives (no polling)
+                selector.select()
+                # the message could have been read by a call (GUI thread)
+                while self.attached and self.pipe.poll():
+                    self.run()
         except EOFError as e:
             print("DEBUGGER disconnected...")
             self.detach()
@@ -143,6 +385,11 @@ class CallbackFrontend(Frontend):
             import sys
             sys.exit()
         finally:
+            selector.close()
+            with self._wakeup_lock:
+                wakeup_w, self._wakeup_w = self._wakeup_w, None
+                os.close(wakeup_w)
+                os.close(self._wakeup_r)
             return True
 
     def init(self, cont=False):
@@ -152,23 +399,41 @@ class CallbackFrontend(Frontend):
         self.unrecoverable_error = None
         self.quitting = False
         self.post_event = True
+        self._quiet_calls = 0
         self.lineno = None
 
-    def attach(self, host='localhost', port=6000, authkey=b'secret password'):
-        self.address = (host, port)
+    def attach(self, host='localhost', port=6000, authkey=b'secret password',
+               address=None):
+        """Connect to the backend at host:port, or at address ('unix:PATH'
+        or 'fd:N' for an already connected socket, see parse_address)"""
+        self.address = address or (host, port)
         self.authkey = authkey
         self.pipe = LoggingPipeWrapper(JsonClient(self.address, authkey=self.authkey))
         self.attached = True
+        self._attached_event.set()
         print("DEBUGGER connected!")
 
     def detach(self):
+        if self.attached and self.pipe:
+            print("DEBUGGER protocol statistics:", self.pipe.stats)
         self.attached = False
+        with self._deferred_lock:
+            future, self._exec_future = self._exec_future, None
+            self._deferred = []
+        if future is not None:
+            # no response will come
+            self._post("exec-result", ("*** detached", ))
+        self._transfers.clear()
+        # stop the reader thread (if it is waiting for data)
+        with self._wakeup_lock:
+            if self._wakeup_w is not None:
+                os.write(self._wakeup_w, b"x")
         if self.pipe:
             self.pipe.close()
         self.clear_interaction()
 
     def is_remote(self):
-        return (self.attached and
+        return (self.attached and isinstance(self.address, tuple) and
                 self.address[0] not in ("localhost"))
 
     def check_interaction(fn):
@@ -192,6 +457,35 @@ class CallbackFrontend(Frontend):
             print("cannot interrupt now (readline): debugger is waiting your user input at the Console window")
             return True
 
+    def resuming(fn):
+        """Decorator for the calls that resume the program: not interacting
+        once answered (the replies to the calls sent before, and their
+        interaction notifications, come first; the next stop is only read
+        after the flag is cleared, as the read lock is held meanwhile)"""
+        def resume_fn(self, *args, **kwargs):
+            self.CancelTransfers()      # the variables will change
+            with self.read_lock:
+                ret = fn(self, *args, **kwargs)
+                self.interacting = False
+                with self._quiet_lock:
+                    self._quiet_calls = 0
+            return ret
+        return resume_fn
+
+    def deferred_during_exec(method):
+        """Decorator for the breakpoint changes: while a console statement
+        runs the reply would wait for it (blocking the GUI), so the remote
+        method is called when it ends (see _exec_done)"""
+        def decorator(fn):
+            def check_fn(self, *args):
+                with self._deferred_lock:
+                    if self._exec_future is not None:
+                        self._deferred.append((method, args))
+                        return True
+                return fn(self, *args)
+            return check_fn
+        return decorator
+
     def force_interaction(fn):
         "Decorator for functions that need to break immediately"
         def check_fn(self, *args, **kwargs):
@@ -235,7 +529,7 @@ class CallbackFrontend(Frontend):
 
     def clear_interaction(self):
         self.interacting = False
-        self.messages_queue.put(("clear-interaction", ()))
+        self._post("clear-interaction", ())
         # interaction is done, clean current line marker
         #wx.PostEvent(self.gui, DebugEvent(EVT_DEBUG_ID, 
         #                                 (None, None, None, None)))
@@ -285,27 +579,36 @@ class CallbackFrontend(Frontend):
     # Methods to handle user interaction by main thread bellow:
 
     @check_interaction
+    @resuming
     def Continue(self, filename=None, lineno=None):
         "Execute until the program ends, a breakpoint is hit or interrupted"
         print("Continue")
         if filename and lineno:
-            # set a temp breakpoint (continue to...)
-            self.set_burst(2)
-            self.do_set_breakpoint(filename, lineno, temporary=1)
-        self.do_continue()
+            # set a temp breakpoint (continue to...) and resume, at once
+            batch = self.new_batch()
+            batch.add('do_set_breakpoint', filename, lineno, 1)
+            batch.add('do_continue')
+            err = batch.send()[0]
+            if err:
+                print("Cannot continue to %s:%s: %s" % (filename, lineno, err))
+        else:
+            self.do_continue()
 
     @check_interaction
+    @resuming
     def Step(self):
         "Execute until the next instruction (entering to functions)"
         print("> Stepin")
         self.do_step()
 
     @check_interaction
+    @resuming
     def StepReturn(self):
         "Execute until the end of the current function"
         self.do_return()
 
     @check_interaction
+    @resuming
     def Next(self):
         "Execute until the next line (not entering to functions)"
         print("-> Next")
@@ -315,6 +618,7 @@ class CallbackFrontend(Frontend):
     def Quit(self):
         "Terminate the program being debugged"
         self.quitting = True
+        self.CancelTransfers()
         self.do_quit()
 
     @check_interaction
@@ -332,29 +636,55 @@ class CallbackFrontend(Frontend):
             self.interrupt()
 
     def LoadBreakpoints(self):
-        "Set all breakpoints (remotelly, used at initialization)"
+        "Set all breakpoints (remotelly, in a single message)"
+        batch = self.new_batch()
+        self._add_breakpoints(batch)
+        for err in batch.send():
+            if err:
+                print("Breakpoint not set: %s" % err)
+
+    def _add_breakpoints(self, batch):
         for bk in self._breakpoints:
-            self.do_set_breakpoint(bk.fn, bk.line, bk.temporary, None)
+            if bk.template:
+                batch.add('do_set_logpoint', bk.fn, bk.line, bk.template,
+                          bk.condition)
+            else:
+                batch.add('do_set_breakpoint', bk.fn, bk.line, bk.temporary,
+                          bk.condition, bk.ignore, bk.every)
 
-    def SetBreakpointOffline(self, filename, lineno, temporary=0, cond=None):
+    def SetBreakpointOffline(self, filename, lineno, temporary=0, cond=None,
+                             ignore=0, every=0):
         print("Adding breakpoint: ", filename, lineno)
-        self._breakpoints.add(LineBreakpoint(filename, lineno, temporary))
+        self._breakpoints.add(LineBreakpoint(filename, lineno, temporary,
+                                             cond, ignore, every))
 
+    @deferred_during_exec('do_set_breakpoint')
     @force_interaction
-    def SetBreakpoint(self, filename, lineno, temporary=0, cond=None):
-        "Set the specified breakpoint (remotelly)"
-        self.do_set_breakpoint(filename, lineno, temporary, cond)
+    def SetBreakpoint(self, filename, lineno, temporary=0, cond=None,
+                      ignore=0, every=0):
+        """Set the specified breakpoint (remotelly), the condition and hit
+        counts (ignore the first N hits, stop every Nth) are checked there"""
+        self.do_set_breakpoint(filename, lineno, temporary, cond,
+                               ignore, every)
 
     def ClearBreakpointOffline(self, filename, lineno, temporary=0):
         "Remove the specified breakpoint (remotelly)"
         bk = LineBreakpoint(filename, lineno, temporary)
         self._breakpoints.remove(bk)
 
+    @deferred_during_exec('do_set_logpoint')
+    @force_interaction
+    def SetLogpoint(self, filename, lineno, template, cond=None):
+        "Set a logpoint (remotelly), its messages are shown in the console"
+        self.do_set_logpoint(filename, lineno, template, cond)
+
+    @deferred_during_exec('do_clear_breakpoint')
     @force_interaction
     def ClearBreakpoint(self, filename, lineno):
         "Remove the specified breakpoint (remotelly)"
         self.do_clear_breakpoint(filename, lineno)
 
+    @deferred_during_exec('do_clear_file_breakpoints')
     @force_interaction
     def ClearFileBreakpoints(self, filename):
         "Remove all breakpoints set for a file (remotelly)"
@@ -419,36 +749,127 @@ class CallbackFrontend(Frontend):
 #        d['environment'] = env
 #        return d
 
+    # big responses are streamed (see Qdb.send_response): the calls of the
+    # context box don't wait for them, so the progress is drawn meanwhile
+
+    @check_interaction
+    def Refresh(self):
+        """Get the call stack and all the scopes in a single message, without
+        waiting: posted as a refresh-result event (used by the context box if
+        it lost a diff). Return None while a console statement runs"""
+        if self._exec_future is not None:
+            return None     # (it would wait for the statement)
+        # several can be in flight: ignore an interaction notification each
+        with self._quiet_lock:
+            self._quiet_calls += 1
+        requests = [{'method': 'do_where', 'args': (), 'kwargs': {}},
+                    {'method': 'do_scopes', 'args': (), 'kwargs': {}}]
+        future = self.call_async('do_batch', requests)
+        self._transfers.add(future)
+        future.add_done_callback(self._refresh_done)
+        return future
+
+    def _refresh_done(self, future):
+        "the call stack and scopes arrived (called by the reader)"
+        self._transfers.discard(future)
+        if future.error:
+            print("error: ", future.error['message'])
+            self._quiet_call_failed()
+            return
+        call_stack, scopes = future.value
+        for response in (call_stack, scopes):
+            if response['error']:
+                print("error: ", response['error']['message'])
+                return
+        self._post("refresh-result", ({'call_stack': call_stack['result'],
+                                       'scopes': scopes['result']}, ))
+
+    @check_interaction
+    def Inspect(self, handle, start=0):
+        """Get a page of the children of a variable, without waiting: posted
+        as an inspect-result event, None if it failed (used by the context
+        box). Return None while a console statement runs"""
+        if self._exec_future is not None:
+            return None     # (it would wait for the statement)
+        with self._quiet_lock:
+            self._quiet_calls += 1
+        future = self.call_async('do_inspect', handle, start)
+        self._transfers.add(future)
+        future.add_done_callback(
+            lambda future: self._inspect_done(future, handle, start))
+        return future
+
+    def _inspect_done(self, future, handle, start):
+        "the page of children arrived (called by the reader)"
+        self._transfers.discard(future)
+        if future.error:
+            print("error: ", future.error['message'])
+            self._quiet_call_failed()
+        self._post("inspect-result", (handle, start, future.value))
+
+    def _quiet_call_failed(self):
+        "no interaction notification follows an error if the program runs"
+        with self._quiet_lock:
+            if not self.interacting and self._quiet_calls:
+                self._quiet_calls -= 1
+
+    def CancelTransfers(self):
+        "Stop receiving the Inspect / Refresh responses (they fail then)"
+        for future in list(self._transfers):
+            if self.attached:
+                future.cancel()
+
     # methods used by the shell:
 
-    def Exec(self, statement, write=None, readline=None):
-        "Exec source code statement in debugger context (returns string)"
+    def Exec(self, statement):
+        """Exec source code statement in debugger context, without waiting:
+        the result (string) is posted as an exec-result event. Return the
+        Future (see CancelExec) or a message if it can't be executed"""
         if statement == "" or not self.attached:
             # 1. shell seems to call Exec without statement on init
             # 2. if not debuging, exec on the current local wx shell
-            pass
+            return None
         elif not self.interacting:
             return '*** no debugger interaction (stop first!)'
+        elif self._exec_future is not None:
+            return '*** a statement is still being executed'
+        self.post_event = None   # ignore one interaction notification
+        # execute the statement in the remote debugger:
+        future = self._exec_future = self.call_async('do_exec', statement)
+        future.add_done_callback(self._exec_done)
+        return future
+
+    def _exec_done(self, future):
+        "the console statement finished (called by the reader)"
+        with self._deferred_lock:
+            self._exec_future = None
+            deferred, self._deferred = self._deferred, []
+        for method, args in deferred:
+            # (not waiting here: the reader would process the replies)
+            with self._quiet_lock:
+                self._quiet_calls += 1
+            self.call_async(method, *args).add_done_callback(
+                self._deferred_done)
+        if future.error:
+            print("error: ", future.error['message'])
+            result = future.error['message']
         else:
-            old_write = self.write
-            old_readline = self.readline
-            try:
-                # replace console function
-                if write:
-                    self.write = write
-                if readline:
-                    self.readline = readline
-                self.post_event = None   # ignore one interaction notification
-                # execute the statement in the remote debugger:
-                ret = self.do_exec(statement)
-                return ret
-            except qdb.RPCError as e:
-                print("error: ", e)
-                return str(e)
-            finally:
-                self.write = old_write
-                self.readline = old_readline
-        return None
+            result = future.value
+        self._post("exec-result", (result, ))
+
+    def _deferred_done(self, future):
+        "a breakpoint change sent after the statement (called by the reader)"
+        if future.error:
+            print("error: ", future.error['message'])
+            self._quiet_call_failed()
+        elif future.value:
+            print("Breakpoint change failed: %s" % future.value)
+
+    def CancelExec(self):
+        "Interrupt the console statement being executed (if any)"
+        future = self._exec_future
+        if future is not None and self.attached:
+            future.cancel()
 
 #    def GetAutoCompleteList(self, expr=''):
 #        "Return list of auto-completion options for an expression"
@@ -1,11 +1,17 @@
 import os
-from gi.repository import Gtk, Gio, GdkPixbuf
+from gi.repository import Gio, GdkPixbuf
 
 MODULE_DIRECTORY = os.path.dirname(__file__)
 ICONS_DIR = os.path.join(MODULE_DIRECTORY, "images")
 
+_pixbufs = {}   # image file: pixbuf (shared, loaded once)
+
 def get_pixbuf_from_file(image_file):
-    return GdkPixbuf.Pixbuf.new_from_file(os.path.join(ICONS_DIR, image_file))
+    pixbuf = _pixbufs.get(image_file)
+    if pixbuf is None:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(ICONS_DIR, image_file))
+        _pixbufs[image_file] = pixbuf
+    return pixbuf
 
 def get_giofileicon_from_file(image_file):
     return Gio.FileIcon.new(Gio.File.new_for_path(os.path.join(ICONS_DIR, image_file)))
@@ -14,7 +20,6 @@ BREAKPOINT_PIXBUF = "breakpoint.png"
 # BREAKPOINT_HIT_PIXBUF = "breakpoint_hit.png"
 CURRENT_STEP_PIXBUF = "current_step.png"
 DEBUGGER_CONSOLE_PIXBUF = "debugger_console.png"
-DEBUGGER_CONSOLE_IMAGE = Gtk.Image.new_from_pixbuf(get_pixbuf_from_file(DEBUGGER_CONSOLE_PIXBUF))
 
 DEBUG_ICON = "debug_executable.png"
 STEP_INTO_ICON = "step_into_instruction.png"
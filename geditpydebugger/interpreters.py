@@ -0,0 +1,200 @@
+"Python interpreters discovery (in the background, cached on disk)"
+
+# Candidates: python, pythonX and pythonX.Y in the PATH directories, the
+# active virtualenv / conda environment, the virtualenvwrapper and pyenv
+# ones, and the project virtualenvs (.venv, venv, env) of the debugged file.
+# Their versions are asked by running them, so the results are cached in
+# the user cache directory, by PATH: they are reused while the binaries and
+# the directories that contain them are not modified.
+
+import json
+import os
+import re
+import subprocess
+import threading
+
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                          os.path.expanduser(os.path.join("~", ".cache")),
+                          "gqdb", "interpreters.json")
+
+INTERPRETER_NAME = re.compile(r"^python(\d+(\.\d+)?)?$")
+PROJECT_VENVS = (".venv", "venv", "env")
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _environments():
+    "Directories of the virtualenvs known without a project (bin excluded)"
+    envs = [os.environ.get("VIRTUAL_ENV"), os.environ.get("CONDA_PREFIX")]
+    for root in (os.environ.get("WORKON_HOME") or
+                 os.path.expanduser(os.path.join("~", ".virtualenvs")),
+                 os.path.expanduser(os.path.join("~", ".pyenv", "versions"))):
+        try:
+            envs.extend(os.path.join(root, name)
+                        for name in sorted(os.listdir(root)))
+        except OSError:
+            pass
+    return [env for env in envs if env]
+
+
+def project_interpreters(file_path):
+    """Interpreters of the file's project virtualenvs (the closest first),
+    the version is read from their pyvenv.cfg (nothing is run)"""
+    interpreters = []
+    directory = os.path.dirname(os.path.abspath(file_path))
+    while True:
+        for name in PROJECT_VENVS:
+            env = os.path.join(directory, name)
+            path = os.path.join(env, "bin", "python")
+            version = _venv_version(env)
+            if version and os.access(path, os.X_OK):
+                interpreters.append([label(path, version), path])
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return interpreters
+        directory = parent
+
+
+def _venv_version(env):
+    try:
+        with open(os.path.join(env, "pyvenv.cfg")) as f:
+            for line in f:
+                key, sep, value = line.partition("=")
+                if key.strip() in ("version", "version_info") and sep:
+                    return value.strip()
+    except (IOError, OSError):
+        pass
+
+
+def candidates(search_path):
+    "Return the directories to check (for the cache) and the interpreters"
+    directories = [d for d in search_path.split(os.pathsep) if d]
+    directories += [os.path.join(env, "bin") for env in _environments()]
+    found = []
+    for directory in directories:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            if INTERPRETER_NAME.match(name) and os.access(path, os.X_OK) \
+               and not os.path.isdir(path):
+                found.append(path)
+    return directories, found
+
+
+def get_version(path):
+    "Run the interpreter to get its version (None if it fails)"
+    try:
+        out = subprocess.check_output([path, "--version"],
+                                      stderr=subprocess.STDOUT,
+                                      stdin=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r"\d+(\.\d+)+", out.decode("utf-8", "replace"))
+    return match and match.group(0)
+
+
+def label(path, version):
+    "Name shown for the interpreter (with its virtualenv, if any)"
+    env = os.path.dirname(os.path.dirname(path))
+    name = os.path.basename(path)
+    if os.path.exists(os.path.join(env, "pyvenv.cfg")) or \
+       os.path.exists(os.path.join(env, "conda-meta")):
+        name = "%s (%s)" % (name, os.path.basename(env))
+    return "%s %s" % (name, version)
+
+
+class InterpreterFinder(object):
+    """Find the interpreters in a thread (see get): the versions are cached
+    on disk by PATH, and reused while the binaries are unchanged"""
+
+    def __init__(self, cache_path=CACHE_PATH):
+        self.cache_path = cache_path
+        self.interpreters = None    # [name, path] (when found)
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._thread = None
+
+    def get(self, callback):
+        """Call callback(interpreters) when they are known: at once with the
+        ones found the last time (checked again in the background for the
+        next call, i.e. a virtualenv was created), else from the thread"""
+        with self._lock:
+            interpreters = self.interpreters
+            if interpreters is None:
+                self._callbacks.append(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="gqdb-interpreters")
+                self._thread.daemon = True
+                self._thread.start()
+            if interpreters is None:
+                return
+        callback(interpreters)
+
+    def _run(self):
+        try:
+            interpreters = self.find()
+        except Exception as e:
+            print("Error detecting python runtimes: %s" % e)
+            interpreters = []
+        print("Detected python runtimes: %s" % interpreters)
+        with self._lock:
+            self.interpreters = interpreters
+            self._thread = None
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(interpreters)
+
+    def find(self, search_path=None):
+        "Discover the interpreters (blocking), updating the disk cache"
+        search_path = os.environ.get("PATH", "") if search_path is None \
+            else search_path
+        cache = self._load()
+        entry = cache.get(search_path) or {}
+        directories, paths = candidates(search_path)
+        mtimes = dict((path, _mtime(path)) for path in directories + paths)
+        if entry.get("mtimes") == mtimes:
+            return entry["interpreters"]
+        # run only the new or modified interpreters
+        versions = entry.get("versions", {})
+        old_mtimes = entry.get("mtimes", {})
+        interpreters, seen = [], set()
+        for path in paths:
+            real = os.path.realpath(path)
+            if real in seen:
+                continue    # i.e. python3 -> python3.11
+            seen.add(real)
+            version = versions.get(path)
+            if version is None or old_mtimes.get(path) != mtimes[path]:
+                version = versions[path] = get_version(path)
+            if version:
+                interpreters.append([label(path, version), path])
+        cache[search_path] = {"mtimes": mtimes, "versions": versions,
+                              "interpreters": interpreters}
+        self._save(cache)
+        return interpreters
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, cache):
+        try:
+            directory = os.path.dirname(self.cache_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.cache_path, "w") as f:
+                json.dump(cache, f)
+        except (IOError, OSError) as e:
+            print("Cannot save the python runtimes cache: %s" % e)
@@ -1,32 +1,280 @@
 import json
-from multiprocessing.connection import Listener, Client
+import marshal
+import socket
+import struct
+import sys
+import zlib
+from multiprocessing.connection import Listener, Client, arbitrary_address
+try:
+    from multiprocessing.connection import Connection
+except ImportError:
+    from _multiprocessing import Connection     # Python 2
+
+# Message codecs: JSON (default, text) or a compact binary encoding (marshal
+# format 2: length-prefixed strings and containers, written and read in C,
+# keeps tuples).  Python 2 and 3 marshal text differently (str vs unicode),
+# so the binary codec is only offered between the same major versions.
+# Binary messages start with a byte that can't start a UTF-8 JSON text, so
+# the receiving side decodes both, whatever codec it uses to send; but
+# marshal must not read untrusted data: binary messages are only decoded
+# once the codec was negotiated on the connection (see set_codec).
+
+BINARY_MAGIC = b'\xc1'
+MARSHAL_VERSION = 2
+
+
+def payload(data):
+    "The data after the magic byte (not copied, but Python 2 needs a str)"
+    if sys.version_info[0] < 3:
+        return bytes(data[1:])
+    return memoryview(data)[1:]
+
+# Big messages can be sent in chunks (see ConnectionWrapper.send_chunked):
+# each one is a frame with its own magic byte, the message id, the offset
+# and the total size of the encoded message.  The receiver copies each part
+# in place into a buffer of that size, returns a 'chunk' notification for
+# each frame (progress) and the message decoded from the buffer after the
+# last one.
+CHUNK_MAGIC = b'\xc2'
+CHUNK_HEADER = struct.Struct('!IQQ')
+CHUNK_SIZE = 64 * 1024
+
+# Messages bigger than a threshold can be compressed (zlib, once negotiated,
+# see set_compression): the encoded message is prefixed with another magic
+# byte, so it is detected like the codecs (before decoding, after chunking)
+ZLIB_MAGIC = b'\xc3'
+COMPRESS_THRESHOLD = 4096     # bytes
+COMPRESS_LEVEL = 6
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024    # bytes (encoded, uncompressed)
+
+
+class JsonCodec(object):
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data.decode("utf-8"))
+
+
+class BinaryCodec(object):
+    name = 'binary%d' % sys.version_info[0]
+
+    def dumps(self, obj):
+        try:
+            return BINARY_MAGIC + marshal.dumps(obj, MARSHAL_VERSION)
+        except ValueError:
+            # subclasses (i.e. OrderedDict) and such: the peer decodes both
+            return CODECS['json'].dumps(obj)
+
+    def loads(self, data):
+        if data[:1] != BINARY_MAGIC:
+            raise ValueError("not a binary message")
+        return marshal.loads(payload(data))
+
+
+CODECS = dict((codec.name, codec) for codec in (JsonCodec(), BinaryCodec()))
+
+
+class ProtocolError(IOError):
+    "A message that can't be decoded (the connection can't be trusted)"
+    pass
+
+
+def set_nodelay(conn):
+    "Disable Nagle's algorithm: pipelined small messages must not wait ACKs"
+    try:
+        sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    except (AttributeError, IOError, OSError):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (IOError, OSError):
+        pass    # not a TCP socket (i.e. AF_UNIX)
+    finally:
+        sock.close()     # a duplicate of the connection descriptor
+
 
 class ConnectionWrapper(object):
-    def __init__(self, conn):
+    def __init__(self, conn, codec='json'):
         self._conn = conn
+        self.codec = CODECS[codec]
+        self.binary = codec != 'json'   # binary messages can be received
+        self._chunks = {}       # message id: parts received (see recv)
+        self.compress_threshold = None      # see set_compression
+        self.zlib = False       # compressed messages can be received
+        # protocol statistics (frames and bytes on the wire)
+        self.stats = {'sent': 0, 'bytes_sent': 0, 'received': 0,
+                      'bytes_received': 0, 'compressed': 0, 'bytes_saved': 0}
 
         for attr in ('fileno', 'close', 'poll', 'recv_bytes', 'send_bytes'):
             obj = getattr(conn, attr)
             setattr(self, attr, obj)
-            
+        set_nodelay(conn)
+
+    @property
+    def codecs(self):
+        "Names of the codecs supported (to negotiate the one to send with)"
+        return sorted(CODECS)
+
+    @property
+    def compressions(self):
+        "Names of the compressions supported (decoded once negotiated)"
+        return ['zlib']
+
+    def accept_codec(self, name):
+        "Decode the messages received with the codec (sending unchanged)"
+        if name not in CODECS:
+            raise ValueError("Unknown codec: %s" % name)
+        if name != 'json':
+            self.binary = True
+
+    def set_codec(self, name):
+        "Send with the codec (binary ones are decoded from now on)"
+        self.accept_codec(name)
+        self.codec = CODECS[name]
+
+    def loads(self, data):
+        "Decode a message, whatever the codec used (if negotiated)"
+        if data[:1] == ZLIB_MAGIC:
+            if not self.zlib:
+                raise ValueError("compression not negotiated")
+            inflater = zlib.decompressobj()
+            data = inflater.decompress(payload(data), MAX_MESSAGE_SIZE)
+            if inflater.unconsumed_tail:
+                raise ValueError("message too big (compressed)")
+        if data[:1] == BINARY_MAGIC:
+            if not self.binary:
+                raise ValueError("binary codec not negotiated")
+            return CODECS[BinaryCodec.name].loads(data)
+        return CODECS['json'].loads(data)
+
+    def accept_compression(self):
+        "Decompress the messages received (sending unchanged)"
+        self.zlib = True
+
+    def set_compression(self, threshold=COMPRESS_THRESHOLD):
+        "Compress the messages bigger than threshold bytes (None: never)"
+        self.accept_compression()
+        self.compress_threshold = threshold
+
+    def dumps(self, obj):
+        "Encode a message with the codec, compressed if it is big"
+        data = self.codec.dumps(obj)
+        if self.compress_threshold is not None and \
+           len(data) > self.compress_threshold:
+            packed = ZLIB_MAGIC + zlib.compress(data, COMPRESS_LEVEL)
+            if len(packed) < len(data):
+                self.stats['compressed'] += 1
+                self.stats['bytes_saved'] += len(data) - len(packed)
+                data = packed
+        return data
+
+    def _send_bytes(self, data):
+        self.stats['sent'] += 1
+        self.stats['bytes_sent'] += len(data)
+        self._conn.send_bytes(data)
+
     def send(self, obj):
-        s = json.dumps(obj)
-        self._conn.send_bytes(s.encode("utf-8"))
-        
+        self._send_bytes(self.dumps(obj))
+
+    def send_chunked(self, obj, chunk_size=CHUNK_SIZE, cancelled=None):
+        """Send a message with an id (a response) in chunks if it is big.
+        Return False if cancelled() was true before the last chunk was sent
+        (the receiver drops the parts when it gets another message with
+        the same id, i.e. an error response)"""
+        data = self.dumps(obj)
+        total = len(data)
+        if total <= chunk_size:
+            self._send_bytes(data)
+            return True
+        view = memoryview(data)
+        for offset in range(0, total, chunk_size):
+            if cancelled and cancelled():
+                return False
+            header = CHUNK_MAGIC + CHUNK_HEADER.pack(obj['id'], offset, total)
+            self._send_bytes(header +
+                             view[offset:offset + chunk_size].tobytes())
+        return True
+
     def recv(self):
         s = self._conn.recv_bytes()
+        self.stats['received'] += 1
+        self.stats['bytes_received'] += len(s)
+        if s[:1] == CHUNK_MAGIC:
+            return self._recv_chunk(s)
         try:
-            return json.loads(s.decode("utf-8"))
+            obj = self.loads(s)
         except ValueError as e:
-            print(e, str(s))
+            raise ProtocolError("%s: %r" % (e, s[:80]))
+        if self._chunks and isinstance(obj, dict) and 'result' in obj:
+            self._chunks.pop(obj.get('id'), None)     # cancelled
+        return obj
+
+    def _recv_chunk(self, s):
+        "Return a chunk notification, the response after the last one"
+        id, offset, total = CHUNK_HEADER.unpack_from(s, 1)
+        data = self._chunks.get(id)
+        if data is None and total <= MAX_MESSAGE_SIZE:
+            data = self._chunks[id] = bytearray(total)
+        part = memoryview(s)[1 + CHUNK_HEADER.size:]
+        if data is not None:
+            data[offset:offset + len(part)] = part
+        received = offset + len(part)
+        if received < total:
+            return {'method': 'chunk', 'id': None,
+                    'args': (id, received, total)}
+        self._chunks.pop(id, None)
+        try:
+            if data is None:
+                raise ValueError("message too big (%d bytes)" % total)
+            return self.loads(data)
+        except ValueError as e:
+            # (only responses are chunked): the call fails
+            return {'version': '1.1', 'id': id, 'result': None,
+                    'error': {'code': 0, 'message': str(e)}}
+
+def parse_address(address):
+    """Convert an address string to a multiprocessing.connection one:
+    'unix:PATH' (AF_UNIX, a new temporary path if empty), 'fd:N' (an
+    inherited connected socket, i.e. one end of a socketpair, returned as
+    an int) or 'HOST:PORT' (AF_INET), anything else is returned as is"""
+    if not isinstance(address, str):
+        return address
+    if address.startswith('unix:'):
+        return address[5:] or arbitrary_address('AF_UNIX')
+    elif address.startswith('fd:'):
+        return int(address[3:])
+    elif ':' in address:
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return address
+
+
+def format_address(address):
+    "Convert a multiprocessing.connection address to a string (see above)"
+    if isinstance(address, tuple):
+        return "%s:%d" % address
+    elif isinstance(address, int):
+        return "fd:%d" % address
+    return "unix:%s" % address
+
 
 class JsonListener(Listener):
+    def __init__(self, address=None, *args, **kwds):
+        Listener.__init__(self, parse_address(address), *args, **kwds)
+
     def accept(self):
         obj = Listener.accept(self)
         return ConnectionWrapper(obj)
 
-def JsonClient(*args, **kwds):
-    return ConnectionWrapper(Client(*args, **kwds))
+def JsonClient(address, *args, **kwds):
+    address = parse_address(address)
+    if isinstance(address, int):
+        # already connected (and private): no authentication
+        return ConnectionWrapper(Connection(address))
+    return ConnectionWrapper(Client(address, *args, **kwds))
 
 
 # Ugly patching to fixe py2<->py3 multiprocessing compatibility
@@ -34,8 +282,13 @@ def JsonClient(*args, **kwds):
 
 from py3compat import PY3
 from multiprocessing import connection, AuthenticationError
-from multiprocessing.connection import CHALLENGE, WELCOME, \
-    MESSAGE_LENGTH, FAILURE
+try:
+    from multiprocessing.connection import CHALLENGE, WELCOME, \
+        MESSAGE_LENGTH, FAILURE
+except ImportError:
+    # Python 3.12+ made the handshake constants private
+    from multiprocessing.connection import _CHALLENGE as CHALLENGE, \
+        _WELCOME as WELCOME, MESSAGE_LENGTH, _FAILURE as FAILURE
 import os
 import hashlib
 
@@ -63,4 +316,35 @@ def deliver_challenge(conn, authkey):
         raise AuthenticationError('digest received was wrong')
 
 connection.deliver_challenge = deliver_challenge
-connection.answer_challenge = answer_challenge
\ No newline at end of file
+connection.answer_challenge = answer_challenge
+
+def benchmark(count=2000):
+    "Compare the codecs encoding and decoding a typical interaction message"
+    import timeit
+    stack = [("/home/user/project/module%d.py" % i, i * 10, "", "",
+              "    result = process(items, key=%d)\n" % i) for i in range(15)]
+    rows = [("name%d" % i, '[1, ["k", "name%d"]]' % i, "list",
+             "[%d, 'text', {'a': 1.5}]" % i, True) for i in range(30)]
+    message = {'method': 'interaction', 'id': None,
+               'args': ("/home/user/project/main.py", 42,
+                        "    x = compute(y)\n"),
+               'kwargs': {'call_stack': stack,
+                          'scopes': [{'name': 'locals', 'handle': '[1]',
+                                      'start': 0, 'total': 30,
+                                      'version': 7, 'children': rows}]}}
+    for name in sorted(CODECS):
+        codec = CODECS[name]
+        data = codec.dumps(message)
+        dumps = timeit.timeit(lambda: codec.dumps(message), number=count)
+        loads = timeit.timeit(lambda: codec.loads(data), number=count)
+        print("%-8s %6d bytes  encode %8.1f msg/s  decode %8.1f msg/s" % (
+              name, len(data), count / dumps, count / loads))
+        packed = zlib.compress(data, COMPRESS_LEVEL)
+        packs = timeit.timeit(lambda: zlib.compress(data, COMPRESS_LEVEL),
+                              number=count)
+        print("%-8s %6d bytes  compress %6.1f msg/s" % (
+              "  +zlib", len(packed) + 1, count / packs))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -2,17 +2,23 @@ import sys
 
 PY3 = sys.version_info[0] >= 3
 if PY3:
+    from queue import Queue, Empty
     raw_input = input
     xrange = range
     integer_types = (int,)
     string_types = (str,)
     long = int
+    def iteritems(d):
+        return iter(d.items())
     def execfile(fname, globs, locs=None):
         exec(compile(open(fname).read(), fname, 'exec'), globs, locs or globs)
 else:
+    from Queue import Queue, Empty
     raw_input = raw_input
     xrange = xrange
     integer_types = (int, long)
     string_types = (basestring,)
     execfile = execfile
-    long = long
\ No newline at end of file
+    long = long
+    def iteritems(d):
+        return d.iteritems()
\ No newline at end of file
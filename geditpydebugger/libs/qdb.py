@@ -15,35 +15,274 @@ __version__ = "1.03b"
 # based on idle, inspired by pythonwin implementation, taken many code from pdb
 
 import bdb
+import dis
 import inspect
 import linecache
 import os
+import re
 import sys
+import time
 import traceback
 import cmd
-import pydoc
+import fnmatch
+import itertools
+import json
+import site
+import sysconfig
 import threading
+import weakref
 
 sys.path.append(os.path.dirname(__file__))
 
 from py3compat import *
+from saferepr import saferepr
 
 
-# Speed Ups: global variables
-breaks = []
-poll = None
+# logpoint messages are sent in batches (by count or age of the first one)
+LOG_BATCH_SIZE = 100
+LOG_BATCH_TIME = 0.25   # seconds
+
+# program output (print) is sent in chunks (by size or age of the first write)
+OUTPUT_BATCH_SIZE = 8192    # characters
+OUTPUT_BATCH_TIME = 0.05    # seconds
+
+# variable inspection: opaque handles are json encoded paths from a scope
+# ([scope, [kind, key], ...]), so they can be resolved again at later stops
+LOCALS_HANDLE = json.dumps([1])
+GLOBALS_HANDLE = json.dumps([2])
+INSPECT_PAGE = 100      # children sent per do_inspect call
+CONSOLE_REPR_CHARS = 4096   # longest result shown for a console statement
+
+# pipelined calls (Frontend.call_all): requests in flight before waiting for
+# the oldest response (so the socket buffers of both sides do not fill up)
+PIPELINE_WINDOW = 64
+
+# responses bigger than this (encoded) are streamed in chunks: the frontend
+# gets progress notifications and can cancel them (see Qdb.send_response)
+STREAM_CHUNK_SIZE = 64 * 1024     # bytes
+
+
+def async_raise(ident, exc_type):
+    """Raise exc_type in a thread (the next time it runs Python code, not
+    while blocked in a C call), None clears it: return False if it can't"""
+    try:
+        import ctypes
+        set_async_exc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+    except (ImportError, AttributeError):
+        return False    # i.e. not CPython
+    exc = ctypes.py_object(exc_type) if exc_type else None
+    return set_async_exc(ctypes.c_ulong(ident), exc) == 1
+
+
+def is_handle_key(key):
+    "Return True if a dict key can be stored in a handle (as JSON)"
+    if isinstance(key, tuple):
+        return all(is_handle_key(item) for item in key)
+    return key is None or isinstance(key, string_types + integer_types +
+                                     (float, ))
+
+
+def handle_key(key):
+    "Rebuild a tuple key from its JSON (nested lists)"
+    if isinstance(key, list):
+        return tuple(handle_key(item) for item in key)
+    return key
+
+
+class BreakpointIndex(object):
+    "Breakpoint lines by canonic filename, looked up by code object"
+
+    # code objects are not used as keys: they compare (and hash) by content,
+    # so the same function compiled from two files would share an entry
+
+    def __init__(self, canonic):
+        self.canonic = canonic
+        self.files = {}         # canonic filename: set of breakpoint lines
+        self.names = {}         # co_filename: line set shared with its file
+        self.code_lines = {}    # id(code): (weakref, line numbers of its body)
+
+    def lookup(self, code):
+        "Return the (live) set of breakpoint lines for the code's file"
+        lines = self.names.get(code.co_filename)
+        if lines is None:
+            filename = self.canonic(code.co_filename)
+            lines = self.names[code.co_filename] = \
+                self.files.setdefault(filename, set())
+        return lines
+
+    def code_breaks(self, code):
+        "Return True if a breakpoint is set on a line of the code object"
+        lines = self.lookup(code)
+        if not lines:
+            return False
+        return not lines.isdisjoint(self._code_lines(code))
+
+    def _code_lines(self, code):
+        key = id(code)
+        entry = self.code_lines.get(key)
+        if entry is not None and entry[0]() is code:
+            return entry[1]
+        code_lines = set(line for offset, line in dis.findlinestarts(code))
+        code_lines.add(code.co_firstlineno)     # function breakpoints
+        code_lines = frozenset(code_lines)
+        entries = self.code_lines
+
+        def forget(ref):
+            # the code object is gone (its id can be reused)
+            if entries.get(key, (None, ))[0] is ref:
+                del entries[key]
+        entries[key] = (weakref.ref(code, forget), code_lines)
+        return code_lines
+
+    def update(self, filename, lines):
+        "Replace the breakpoint lines of a canonic filename"
+        file_lines = self.files.setdefault(filename, set())
+        file_lines.clear()
+        file_lines.update(lines)
+
+
+class CodeFilter(object):
+    "Classify code objects as user, library, stdlib or skipped (once each)"
+
+    USER, LIBRARY, STDLIB, SKIPPED = "user", "library", "stdlib", "skipped"
+
+    def __init__(self, canonic, skip=None):
+        self.canonic = canonic
+        self.skip = list(skip or ())    # module name globs (as bdb skip)
+        self.kinds = {}         # (co_filename, module name): kind
+        paths = sysconfig.get_paths()
+        library = [paths['purelib'], paths['platlib']]
+        if hasattr(site, 'getsitepackages'):     # not in old virtualenvs
+            library.extend(site.getsitepackages())
+        if hasattr(site, 'getusersitepackages'):
+            library.append(site.getusersitepackages())
+        # site-packages is inside the stdlib directory: check it first
+        self.prefixes = [(self._dir(path), self.LIBRARY) for path in library]
+        self.prefixes += [(self._dir(paths[name]), self.STDLIB)
+                          for name in ('stdlib', 'platstdlib')]
+        # the debugger itself (qdb, json_serializer, py3compat)
+        self.prefixes.insert(0, (self._dir(os.path.dirname(__file__)),
+                                 self.SKIPPED))
+
+    def _dir(self, path):
+        return os.path.join(self.canonic(path), "")
+
+    def classify(self, frame):
+        "Return the kind of the frame's code (cached by file and module)"
+        key = (frame.f_code.co_filename, frame.f_globals.get('__name__'))
+        kind = self.kinds.get(key)
+        if kind is None:
+            kind = self.kinds[key] = self._classify(*key)
+        return kind
+
+    def _classify(self, filename, module_name):
+        if module_name:
+            for pattern in self.skip:
+                if fnmatch.fnmatch(module_name, pattern):
+                    return self.SKIPPED
+        if filename.startswith("<frozen "):
+            return self.STDLIB      # importlib bootstrap
+        if filename[:1] + filename[-1:] == "<>":
+            return self.USER        # <string>, <stdin>
+        filename = self.canonic(filename)
+        for prefix, kind in self.prefixes:
+            if filename.startswith(prefix):
+                return kind
+        if os.sep + 'site-packages' + os.sep in filename or \
+           os.sep + 'dist-packages' + os.sep in filename:
+            return self.LIBRARY
+        return self.USER
+
+
+def compile_template(template):
+    """Compile a logpoint message template ('x is {x}', {{ and }} escape
+    the braces) to a % format string and the code of the values tuple"""
+    fmt, exprs = [], []
+    for part in re.split(r'(\{\{|\}\}|\{[^{}]+\})', template):
+        if part in ('{{', '}}'):
+            fmt.append(part[0])
+        elif part[:1] == '{' and part[-1:] == '}':
+            fmt.append('%s')
+            exprs.append('(%s), ' % part[1:-1])
+        else:
+            fmt.append(part.replace('%', '%%'))
+    code = compile('(%s)' % ''.join(exprs), '<logpoint>', 'eval')
+    return ''.join(fmt), code
+
+
+def log_str(value):
+    "str() of a logpoint value, within the saferepr budgets"
+    if isinstance(value, string_types):
+        if len(value) > saferepr.maxchars:
+            return value[:saferepr.maxchars] + '...'
+        return value
+    return saferepr(value)
+
+
+def effective(file, line, frame, log=None):
+    """Determine which breakpoint for this file:line is to be acted upon.
+
+    Same as bdb.effective, but the condition is evaluated from the code object
+    compiled when the breakpoint was set, and hit counts are supported:
+    ignore skips the first N hits, every only stops on each Nth hit.
+    Logpoints never stop: they are passed to log(breakpoint, frame).
+    Returns (breakpoint, ok to delete if temporary) or (None, None).
+    """
+    for b in bdb.Breakpoint.bplist[file, line]:
+        if not b.enabled:
+            continue
+        if not bdb.checkfuncname(b, frame):
+            continue
+        # Count every hit when bp is enabled
+        b.hits += 1
+        if b.cond:
+            cond_code = getattr(b, 'cond_code', None)
+            try:
+                if cond_code is None:
+                    # not set thru do_set_breakpoint (compile it once)
+                    cond_code = b.cond_code = compile(b.cond,
+                                                      '<breakpoint>', 'eval')
+                if not eval(cond_code, frame.f_globals, frame.f_locals):
+                    continue
+            except:
+                # if eval fails, stop regardless of ignore count,
+                # and don't delete temporary (as a hint to user)
+                return (b, False)
+        # ignore and every count only the hits where the condition is true
+        if b.ignore > 0:
+            b.ignore -= 1
+            continue
+        every = getattr(b, 'every', 0)
+        if every > 1:
+            b.every_count = getattr(b, 'every_count', 0) + 1
+            if b.every_count % every:
+                continue
+        if getattr(b, 'log_code', None) is not None:
+            if log:
+                log(b, frame)
+            continue
+        return (b, True)
+    return (None, None)
 
 
 class Qdb(bdb.Bdb):
     "Qdb Debugger Backend"
 
     def __init__(self, pipe, redirect_stdio=True, allow_interruptions=False,
-                 use_speedups=True, skip=[__name__]):
-        global breaks, poll
-        kwargs = {}
-        if sys.version_info > (2, 7):
-            kwargs['skip'] = skip
-        bdb.Bdb.__init__(self, **kwargs)
+                 use_speedups=True, skip=[__name__], engine="settrace"):
+        # skip is not given to bdb (checked with fnmatch on every stop_here):
+        # the code filter checks it once per code object instead
+        bdb.Bdb.__init__(self)
+        self.code_filter = CodeFilter(self.canonic, skip)
+        self.just_my_code = False   # do not stop in stdlib / site-packages
+        # tracing engine: sys.settrace (default) or sys.monitoring (3.12+)
+        if engine == "monitoring":
+            from qdb_monitoring import MonitoringTracer
+            self.tracer = MonitoringTracer(self)
+        elif engine == "settrace":
+            self.tracer = None
+        else:
+            raise ValueError("Unknown tracing engine: %s" % engine)
         self.frame = None
         self.i = 1  # sequential RPC call id
         self.waiting = False
@@ -63,52 +302,178 @@ class Qdb(bdb.Bdb):
         self.allow_interruptions = allow_interruptions
         self.burst = 0          # do not send notifications ("burst" mode)
         self.params = {}        # optional parameters for interaction
-        
-        # if available and enabled, enable speedups:
-        poll = self.pipe.poll
         # flags to reduce overhead (only stop at breakpoint or interrupt)
         self.use_speedups = use_speedups
         self.fast_continue = False
+        self.step_over = False  # next / return: do not trace callees
+        # breakpoint lines indexed for the trace_dispatch fast path
+        self.bp_index = BreakpointIndex(self.canonic)
+        self.log_buffer = []    # logpoint messages not sent yet
+        self.log_time = 0       # when the first buffered message was added
+        self.log_due = None     # when the messages must be sent at last
+        self.break_frame = None # break_here was true for its current line
+        self.output_buffer = [] # program output not sent yet
+        self.output_size = 0
+        self.output_due = None  # when the output must be sent at last
+        # messages are sent by the debugged thread and the flusher thread,
+        # that sends the buffers when due if nothing else does (notified)
+        self.send_lock = threading.Condition(threading.RLock())
+        self.flusher = None
+        # last locals sent at interaction, to only send what changed
+        self.scopes_version = 0
+        self.scopes_frame = None
+        self.scopes_snapshot = {}   # name: (id, hash of the repr)
+        # control channel reader: requests received while running are queued
+        # and flagged, so the trace function doesn't poll the pipe each event
+        self.requests = Queue()
+        self.pending = False
+        self.cancelled = set()  # ids of the responses not to be sent
+        self.open_calls = set() # ids received, not answered yet (see cancel)
+        # a console statement being executed can be interrupted (see cancel)
+        self.current_id = None      # id of the call being dispatched
+        self.exec_lock = threading.Lock()   # also for cancelled / open_calls
+        self.exec_thread = None     # ident of the thread running do_exec
+        self.exec_interrupted = False
+        self.reader = None
+        if allow_interruptions:
+            self.reader = threading.Thread(target=self._read_requests,
+                                           name="qdb-reader")
+            self.reader.daemon = True
+            self.reader.start()
+
+    def _read_requests(self):
+        "Reader thread: queue incoming messages and flag them as pending"
+        while True:
+            try:
+                message = self.pipe.recv()
+            except Exception as e:
+                # connection closed (EOFError, IOError): re-raised by recv
+                self.requests.put(e)
+                return
+            if message and message.get('method') in ('cancel', 'set_codec',
+                                                     'set_compression'):
+                # now: the response could be being sent by the debugged
+                # thread, the next messages could use the codec (compression)
+                try:
+                    getattr(self, message['method'])(*message['args'])
+                except Exception as e:
+                    print("qdb: %s failed: %s" % (message['method'], e))
+                continue
+            if message and message.get('method') and message.get('id'):
+                # a call (not a response)
+                with self.exec_lock:
+                    self.open_calls.add(message['id'])
+            self.requests.put(message)
+            self.pending = True
+            if self.tracer and not self.waiting:
+                self.tracer.wake()
+
+    def recv(self):
+        "Receive the next message from the frontend (blocking)"
+        if not self.reader:
+            return self.pipe.recv()
+        message = self.requests.get()
+        if isinstance(message, Exception):
+            self.requests.put(message)     # the connection is gone for good
+            raise message
+        return message
+
+    def process_pending(self):
+        "Dispatch the requests received while the program was running"
+        self.pending = False
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except Empty:
+                return
+            if isinstance(request, Exception):
+                # leave the error to the next blocking recv (interaction)
+                self.requests.put(request)
+                return
+            self.pull_actions(request)
 
-    def pull_actions(self):
+    def pull_actions(self, request=None):
         # receive a remote procedure call from the frontend:
         # returns True if action processed
         #         None when 'run' notification is received (see 'startup')
-        request = self.pipe.recv()
+        if request is None:
+            request = self.recv()
         if request.get("method") == 'run':
             return None
         response = {'version': '1.1', 'id': request.get('id'), 
                     'result': None, 
                     'error': None}
+        id = request.get('id')
+        if id:
+            with self.exec_lock:
+                self.open_calls.add(id)     # (not read by the reader thread)
+        self.current_id = id
         try:
-            # dispatch message (JSON RPC like)
-            method = getattr(self, request['method'])
-            response['result'] = method.__call__(*request['args'], 
-                                        **request.get('kwargs', {}))
-        except Exception as e:
-            response['error'] = {'code': 0, 'message': str(e)}
-        # send the result for normal method calls, not for notifications
-        if request.get('id'):
-            self.pipe.send(response)
+            try:
+                # dispatch message (JSON RPC like)
+                method = getattr(self, request['method'])
+                response['result'] = method.__call__(*request['args'], 
+                                            **request.get('kwargs', {}))
+            except Exception as e:
+                response['error'] = {'code': 0, 'message': str(e)}
+            finally:
+                self.current_id = None
+            # send the result for normal method calls, not for notifications
+            if id:
+                self.send_response(response)
+        finally:
+            if id:
+                # a cancel received later is ignored (see cancel)
+                with self.exec_lock:
+                    self.open_calls.discard(id)
+                    self.cancelled.discard(id)
         return True
 
+    def send_response(self, response):
+        "Send the result of a call, in chunks if it is big (can be cancelled)"
+        id = response['id']
+        with self.send_lock:
+            self.flush_output()
+            if not hasattr(self.pipe, 'send_chunked'):
+                self.pipe.send(response)    # i.e. QueuePipe
+            elif not self.pipe.send_chunked(response, STREAM_CHUNK_SIZE,
+                                            lambda: id in self.cancelled):
+                self.pipe.send({'version': '1.1', 'id': id, 'result': None,
+                                'error': {'code': 0, 'message': "Cancelled"}})
+
+    def cancel(self, id):
+        """Stop sending the response of a call (see send_response), or
+        interrupt it if it is executing a console statement (see do_exec)"""
+        with self.exec_lock:
+            if id not in self.open_calls:
+                return      # already answered (or unknown)
+            self.cancelled.add(id)
+            if self.exec_thread is not None and id == self.current_id and \
+               not self.exec_interrupted:
+                self.exec_interrupted = async_raise(self.exec_thread,
+                                                    KeyboardInterrupt)
+
     # Override Bdb methods
 
     def trace_dispatch(self, frame, event, arg):
         # check for non-interaction rpc (set_breakpoint, interrupt)
-        while self.allow_interruptions and self.pipe.poll():
-            self.pull_actions()
-            # check for non-interaction rpc (set_breakpoint, interrupt)
-            while poll():
-                self.pull_actions()
-        if (frame.f_code.co_filename, frame.f_lineno) not in breaks and \
-            self.fast_continue:
+        if self.pending:
+            self.process_pending()
+        if self.fast_continue and \
+            frame.f_lineno not in self.bp_index.lookup(frame.f_code):
             return self.trace_dispatch
         # process the frame (see Bdb.trace_dispatch)
         ##if self.fast_continue:
         ##    return self.trace_dispatch
         if self.quitting:
             return # None
+        if event == 'call' and (self.step_over and
+                                frame is not self.stopframe or
+                                self.ignore_frame(frame)) and \
+            not self.bp_index.code_breaks(frame.f_code):
+            # called below the stop frame or not user code (just my code),
+            # and no breakpoints: run it untraced
+            return # None
         if event == 'line':
             return self.dispatch_line(frame)
         if event == 'call':
@@ -119,6 +484,55 @@ class Qdb(bdb.Bdb):
             return self.dispatch_exception(frame, arg)
         return self.trace_dispatch
 
+    def dispatch_return(self, frame, arg):
+        # the caller could be running untraced (called while stepping over):
+        # re-arm it, as it is where the step over / out will stop next
+        if frame.f_back and (frame is self.stopframe or
+                                 frame is self.returnframe) and \
+           not self.ignore_frame(frame.f_back):
+            frame.f_back.f_trace = self.trace_dispatch
+        return bdb.Bdb.dispatch_return(self, frame, arg)
+
+    def ignore_frame(self, frame):
+        "Return True if the debugger never stops in the frame (see stop_here)"
+        kind = self.code_filter.classify(frame)
+        return kind == CodeFilter.SKIPPED or \
+               self.just_my_code and kind != CodeFilter.USER
+
+    def stop_here(self, frame):
+        # skipped modules and, in just my code mode, stdlib and library code
+        if self.ignore_frame(frame):
+            return False
+        return bdb.Bdb.stop_here(self, frame)
+
+    def break_here(self, frame):
+        # same as Bdb.break_here, using the compiled conditions (see effective)
+        filename = self.canonic(frame.f_code.co_filename)
+        if filename not in self.breaks:
+            return False
+        lineno = frame.f_lineno
+        if lineno not in self.breaks[filename]:
+            # maybe the first line of a function with breakpoint set by name
+            lineno = frame.f_code.co_firstlineno
+            if lineno not in self.breaks[filename]:
+                return False
+        # flag says ok to delete temp. bp
+        (bp, flag) = effective(filename, lineno, frame, self.log_hit)
+        if bp:
+            self.currentbp = bp.number
+            if (flag and bp.temporary):
+                self.do_clear(str(bp.number))
+            self.break_frame = frame    # (see user_line)
+            return True
+        else:
+            return False
+
+    def _set_stopinfo(self, stopframe, returnframe, stoplineno=0):
+        bdb.Bdb._set_stopinfo(self, stopframe, returnframe, stoplineno)
+        # stop only in a given frame (next / return): callees are not traced
+        self.step_over = stopframe is not None and \
+                         stopframe is not self.botframe
+
     def user_call(self, frame, argument_list):
         """This method is called when there is the remote possibility
         that we ever need to stop in this function."""
@@ -129,14 +543,18 @@ class Qdb(bdb.Bdb):
    
     def user_line(self, frame):
         """This function is called when we stop or break at this line."""
+        # dispatch_line only evaluates break_here if stop_here is false:
+        # evaluate it once (hit counts, logpoints)
+        hit, self.break_frame = self.break_frame is frame, None
         if self._wait_for_mainpyfile:
             if (not self.canonic(frame.f_code.co_filename).startswith(self.mainpyfile)
                 or frame.f_lineno<= 0):
                 return
             self._wait_for_mainpyfile = 0
         if self._wait_for_breakpoint:
-            if not self.break_here(frame):
+            if not hit and not self.break_here(frame):
                 return
+            self.break_frame = None
             self._wait_for_breakpoint = 0
         self.interaction(frame)
 
@@ -148,49 +566,107 @@ class Qdb(bdb.Bdb):
         extype, exvalue, trace = info
         # pre-process stack trace as it isn't pickeable (cannot be sent pure)
         msg = ''.join(traceback.format_exception(extype, exvalue, trace))
-        trace = traceback.extract_tb(trace)
+        trace = [tuple(entry) for entry in traceback.extract_tb(trace)]
         title = traceback.format_exception_only(extype, exvalue)[0]
         # send an Exception notification
         msg = {'method': 'exception', 
-               'args': (title, extype.__name__, exvalue, trace, msg), 
+               'args': (title, extype.__name__, saferepr(exvalue), trace,
+                        msg), 
                'id': None}
-        self.pipe.send(msg)
+        self.send(msg)
         self.interaction(frame)
 
     def run(self, code, interp=None, *args, **kwargs):
-        try:
+        if not self.tracer:
             return bdb.Bdb.run(self, code, *args, **kwargs)
-        finally:
+        # same as Bdb.run, but with the tracing engine instead of settrace
+        globals, locals = (args + (None, None))[:2]
+        if globals is None:
+            import __main__
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.reset()
+        if isinstance(code, string_types):
+            code = compile(code, "<string>", "exec")
+        self.start_trace()
+        try:
+            exec(code, globals, locals)
+        except bdb.BdbQuit:
             pass
+        finally:
+            self.quitting = True
+            self.stop_trace()
 
     def runcall(self, function, interp=None, *args, **kwargs):
-        try:
-            self.interp = interp
+        self.interp = interp
+        if not self.tracer:
             return bdb.Bdb.runcall(self, function, *args, **kwargs)
-        finally:
+        self.reset()
+        self.start_trace()
+        res = None
+        try:
+            res = function(*args, **kwargs)
+        except bdb.BdbQuit:
             pass
+        finally:
+            self.quitting = True
+            self.stop_trace()
+        return res
+
+    def start_trace(self):
+        "Install the tracing engine (sys.settrace or sys.monitoring)"
+        if self.tracer:
+            self.tracer.start()
+        else:
+            sys.settrace(self.trace_dispatch)
+
+    def stop_trace(self):
+        "Remove the tracing engine"
+        if self.tracer:
+            self.tracer.stop()
+        else:
+            sys.settrace(None)
+
+    def _update_tracing(self):
+        "Let the tracing engine follow stepping and breakpoint changes"
+        if self.tracer:
+            self.tracer.update()
 
     def _runscript(self, filename):
         # The script has to run in __main__ namespace (clear it)
         import __main__
-        import imp
+        try:
+            import imp
+        except ImportError:
+            imp = None      # removed in Python 3.12
         __main__.__dict__.clear()
         __main__.__dict__.update({"__name__"    : "__main__",
                                   "__file__"    : filename,
                                   "__builtins__": __builtins__,
                                   "imp"         : imp,          # need for run
+                                  "execfile"    : execfile,
                                  })
 
         # avoid stopping before we reach the main script 
         self._wait_for_mainpyfile = 1
         self.mainpyfile = self.canonic(filename)
         self._user_requested_quit = 0
-        if sys.version_info>(3,0):
+        if sys.version_info>(3,0) and imp:
             statement = 'imp.load_source("__main__", "%s")' % filename
+        elif sys.version_info>(3,0):
+            statement = 'execfile(%r, globals())' % filename
         else:
             statement = 'execfile(%r)' % filename
         # notify and wait frontend to set initial params and breakpoints
-        self.pipe.send({'method': 'startup', 'args': (__version__, )})
+        startup = {'method': 'startup', 'args': (__version__, )}
+        codecs = getattr(self.pipe, 'codecs', None)
+        if codecs:
+            # the frontend may choose a faster message codec (set_codec)
+            # and compress the big messages (set_compression)
+            startup['kwargs'] = {'codecs': codecs,
+                                 'compressions': self.pipe.compressions}
+        self.send(startup)
         while self.pull_actions() is not None:
             pass
         self.run(statement)
@@ -198,6 +674,7 @@ class Qdb(bdb.Bdb):
     # General interaction function
 
     def interaction(self, frame):
+        self.flush_log()
         # chache frame locals to ensure that modifications are not overwritten
         self.frame_locals = frame and frame.f_locals or {}
         # extract current filename and line number
@@ -227,7 +704,9 @@ class Qdb(bdb.Bdb):
                         kwargs['call_stack'] = self.do_where()
                     if self.params.get('environment'):
                         kwargs['environment'] = self.do_environment()
-                    self.pipe.send({'method': 'interaction', 'id': None,
+                    if self.params.get('scopes'):
+                        kwargs['scopes'] = self.do_scopes(diff=True)
+                    self.send({'method': 'interaction', 'id': None,
                                 'args': (filename, self.frame.f_lineno, line),
                                 'kwargs': kwargs})
 
@@ -235,6 +714,7 @@ class Qdb(bdb.Bdb):
         finally:
             self.waiting = False
         self.frame = None
+        self._update_tracing()
 
     def do_debug(self, mainpyfile=None, wait_breakpoint=1):
         self.reset()
@@ -245,7 +725,7 @@ class Qdb(bdb.Bdb):
                 mainpyfile = frame.f_code.co_filename
             self.mainpyfile = self.canonic(mainpyfile)
         self._wait_for_breakpoint = wait_breakpoint
-        sys.settrace(self.trace_dispatch)
+        self.start_trace()
 
     def set_trace(self, frame=None):
         # start debugger interaction immediatelly
@@ -253,7 +733,15 @@ class Qdb(bdb.Bdb):
             frame = sys._getframe().f_back
         self._wait_for_mainpyfile = frame.f_code.co_filename
         self._wait_for_breakpoint = 0
-        bdb.Bdb.set_trace(self, frame)
+        if not self.tracer:
+            bdb.Bdb.set_trace(self, frame)
+            return
+        self.reset()
+        while frame:
+            self.botframe = frame
+            frame = frame.f_back
+        self.set_step()
+        self.start_trace()
 
     # Command definitions, called by interaction()
 
@@ -280,6 +768,7 @@ class Qdb(bdb.Bdb):
     def interrupt(self):
         self.set_step()
         self.fast_continue = False
+        self._update_tracing()
 
     def do_quit(self):
         self.set_quit()
@@ -323,12 +812,116 @@ class Qdb(bdb.Bdb):
         return lines
 
     def do_read(self, filename):
-        return open(filename, "Ur").read()
-
-    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None):
-        global breaks   # list for speedups!
-        breaks.append((filename.replace("\\", "/"), int(lineno)))
-        return self.set_break(filename, int(lineno), temporary, cond)
+        # universal newlines ("U" mode was removed in Python 3.11)
+        with open(filename, PY3 and "r" or "Ur") as f:
+            return f.read()
+
+    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None,
+                          ignore=0, every=0):
+        filename = self.canonic(filename)
+        lineno = int(lineno)
+        if cond:
+            # compile the condition once, not on each hit (see effective)
+            try:
+                cond_code = compile(cond, '<breakpoint>', 'eval')
+            except SyntaxError as e:
+                return "Invalid condition %r: %s" % (cond, e)
+        err = self.set_break(filename, lineno, temporary, cond)
+        if not err:
+            bp = self.get_breaks(filename, lineno)[-1]
+            if cond:
+                bp.cond_code = cond_code
+            bp.ignore = int(ignore or 0)
+            bp.every = int(every or 0)
+        self._sync_breaks(filename)
+        self._update_tracing()
+        return err
+
+    def do_set_logpoint(self, filename, lineno, template, cond=None):
+        "Set a breakpoint that doesn't stop, just logs the formatted template"
+        try:
+            log_format, log_code = compile_template(template)
+        except SyntaxError as e:
+            return "Invalid template %r: %s" % (template, e)
+        err = self.do_set_breakpoint(filename, lineno, 0, cond)
+        if not err:
+            bp = self.get_breaks(self.canonic(filename), int(lineno))[-1]
+            bp.log_format = log_format
+            bp.log_code = log_code
+            bp.log_template = template
+        return err
+
+    def log_hit(self, bp, frame):
+        "Evaluate a logpoint message and buffer it (see flush_log)"
+        try:
+            values = eval(bp.log_code, frame.f_globals, frame.f_locals)
+            text = bp.log_format % tuple(log_str(value) for value in values)
+        except Exception as e:
+            text = "%s <%s: %s>" % (bp.log_template, type(e).__name__, e)
+        now = time.time()
+        with self.send_lock:
+            if not self.log_buffer:
+                self.log_time = now
+            self.log_buffer.append((bp.file, frame.f_lineno, text))
+            if (len(self.log_buffer) >= LOG_BATCH_SIZE or
+                    now - self.log_time >= LOG_BATCH_TIME):
+                self.flush_log()
+            elif not self.log_due:
+                # the last hit of a burst: send it even if no other comes
+                self.log_due = self.log_time + LOG_BATCH_TIME
+                self._schedule_flush()
+
+    def send(self, msg):
+        "Send a message to the frontend (after the output written before it)"
+        with self.send_lock:
+            self.flush_output()
+            self.pipe.send(msg)
+
+    def flush_output(self):
+        "Send the buffered program output in a single write notification"
+        with self.send_lock:
+            self.output_due = None
+            if self.output_buffer:
+                text = ''.join(self.output_buffer)
+                self.output_buffer = []
+                self.output_size = 0
+                self.pipe.send({'method': 'write', 'args': (text, ),
+                                'id': None})
+
+    def flush_log(self):
+        "Send the buffered logpoint messages in a single notification"
+        with self.send_lock:
+            self.log_due = None
+            if self.log_buffer:
+                messages, self.log_buffer = self.log_buffer, []
+                self.send({'method': 'log', 'args': (messages, ),
+                                'id': None})
+
+    def _schedule_flush(self):
+        "Wake the flusher thread up (started once) to wait for a new due"
+        with self.send_lock:
+            if not self.flusher:
+                self.flusher = threading.Thread(target=self._flush_pending,
+                                                name="qdb-flusher")
+                self.flusher.daemon = True
+                self.flusher.start()
+            self.send_lock.notify()
+
+    def _flush_pending(self):
+        "Flusher thread: send the buffered output and messages when due"
+        with self.send_lock:
+            while True:
+                dues = [due for due in (self.log_due, self.output_due) if due]
+                delay = min(dues) - time.time() if dues else None
+                if delay is None or delay > 0:
+                    self.send_lock.wait(delay)
+                    continue
+                try:
+                    # (the output buffered is older than the messages)
+                    self.flush_log()
+                    self.flush_output()
+                except Exception:
+                    return      # connection closed
 
     def do_list_breakpoint(self):
         breaks = []
@@ -336,20 +929,41 @@ class Qdb(bdb.Bdb):
             for bp in bdb.Breakpoint.bpbynumber:
                 if bp:
                     breaks.append((bp.number, bp.file, bp.line, 
-                        bp.temporary, bp.enabled, bp.hits, bp.cond, ))
+                        bp.temporary, bp.enabled, bp.hits, bp.cond,
+                        bp.ignore, getattr(bp, 'every', 0),
+                        getattr(bp, 'log_template', None), ))
         return breaks
 
     def do_clear_breakpoint(self, filename, lineno):
-        self.clear_break(filename, lineno)
+        filename = self.canonic(filename)
+        err = self.clear_break(filename, int(lineno))
+        self._sync_breaks(filename)
+        self._update_tracing()
+        return err
 
     def do_clear_file_breakpoints(self, filename):
-        self.clear_all_file_breaks(filename)
+        filename = self.canonic(filename)
+        err = self.clear_all_file_breaks(filename)
+        self._sync_breaks(filename)
+        self._update_tracing()
+        return err
 
     def do_clear(self, arg):
         # required by BDB to remove temp breakpoints!
+        try:
+            bp = bdb.Breakpoint.bpbynumber[int(arg)]
+        except (ValueError, IndexError):
+            bp = None
         err = self.clear_bpbynumber(arg)
         if err:
             print('*** DO_CLEAR failed', err)
+        if bp:
+            self._sync_breaks(bp.file)
+            self._update_tracing()
+
+    def _sync_breaks(self, filename):
+        "Update the breakpoint index from the bdb table (canonic filename)"
+        self.bp_index.update(filename, self.breaks.get(filename, ()))
 
     def do_eval(self, arg, safe=True):
         if self.frame:
@@ -358,7 +972,7 @@ class Qdb(bdb.Bdb):
         else:
             ret = RPCError("No current frame available to eval")
         if safe:
-            ret = pydoc.cram(repr(ret), 255)
+            ret = saferepr(ret)
         return ret
 
     def do_exec(self, arg, safe=False):
@@ -371,13 +985,30 @@ class Qdb(bdb.Bdb):
             save_displayhook = sys.displayhook
             self.displayhook_value = None
             try:
-                sys.displayhook = self.displayhook
-                exec(code, globals, locals)
-                ret = self.displayhook_value
-            finally:
-                sys.displayhook = save_displayhook
+                try:
+                    with self.exec_lock:
+                        self.exec_thread = threading.current_thread().ident
+                        self.exec_interrupted = False
+                    sys.displayhook = self.displayhook
+                    exec(code, globals, locals)
+                    ret = self.displayhook_value
+                finally:
+                    sys.displayhook = save_displayhook
+                    with self.exec_lock:
+                        self.exec_thread = None
+                        if self.exec_interrupted:
+                            # cancelled as it finished: not raised yet
+                            async_raise(threading.current_thread().ident,
+                                        None)
+            except KeyboardInterrupt:
+                if not self.exec_interrupted:
+                    raise
+                # (it could be raised in the finally clause, before the lock)
+                with self.exec_lock:
+                    self.exec_thread = None
+                raise RPCError("Interrupted")
         if safe:
-            ret = pydoc.cram(repr(ret), 255)
+            ret = saferepr(ret)
         return ret
 
     def do_where(self):
@@ -396,11 +1027,135 @@ class Qdb(bdb.Bdb):
         # converts the frame global and locals to a short text representation:
         if self.frame:
             for name, value in self.frame_locals.items():
-                env['locals'][name] = pydoc.cram(repr(value), 255), repr(type(value))
+                env['locals'][name] = saferepr(value), repr(type(value))
             for name, value in self.frame.f_globals.items():
-                env['globals'][name] = pydoc.cram(repr(value), 20), repr(type(value))
+                env['globals'][name] = saferepr(value, 20), repr(type(value))
         return env
 
+    def do_scopes(self, diff=False):
+        """Return the scopes of the current frame (with the first locals)
+
+        Locals are versioned: with diff, if the frame is the same than the
+        last time, only the added, changed and removed names since that
+        version (base) are sent, instead of the children.
+        Only when every local fits in the first page: names past it would
+        not be compared, and the added ones could be loaded twice (the
+        frontend reloads the expanded rows, as values can change in place
+        keeping their identity and short repr).
+        """
+        scopes = []
+        if self.frame:
+            local = self.do_inspect(LOCALS_HANDLE)
+            snapshot = None
+            if len(local['children']) == local['total']:
+                snapshot = {}
+                for row in local['children']:
+                    name, value = row[0], self.frame_locals.get(row[0])
+                    snapshot[name] = (id(value), hash(row[3]))
+            previous = self.scopes_snapshot
+            if not diff or self.frame is not self.scopes_frame or \
+               snapshot is None:
+                previous = None
+            self.scopes_version += 1
+            self.scopes_frame, self.scopes_snapshot = self.frame, snapshot
+            local['name'] = 'locals'
+            local['version'] = self.scopes_version
+            if previous is not None:
+                rows = local.pop('children')
+                local['base'] = self.scopes_version - 1
+                local['added'] = [row for row in rows
+                                  if row[0] not in previous]
+                local['changed'] = [row for row in rows if row[0] in previous
+                                    and previous[row[0]] != snapshot[row[0]]]
+                local['removed'] = [name for name in previous
+                                    if name not in snapshot]
+            scopes.append(local)
+            scopes.append({'name': 'globals', 'handle': GLOBALS_HANDLE,
+                           'total': len(self.frame.f_globals),
+                           'start': 0, 'children': None})
+        return scopes
+
+    def do_inspect(self, handle, start=0, count=INSPECT_PAGE):
+        """Return a page of the children of a variable, for each one:
+        (name, handle, type name, short repr, has children); the handle is
+        None if the child can't be found again (i.e. a set member)"""
+        path = json.loads(handle)
+        obj = self._resolve(path)
+        total, children = self._children(obj, start, count,
+                                         path[0] in (1, 2) and len(path) == 1)
+        rows = []
+        for name, step, value in children:
+            if step is None:
+                rows.append((name, None, type(value).__name__,
+                             saferepr(value), False))
+            else:
+                rows.append((name, json.dumps(path + [step]),
+                             type(value).__name__,
+                             saferepr(value),
+                             self._expandable(value)))
+        return {'handle': handle, 'start': start, 'total': total,
+                'children': rows}
+
+    def _resolve(self, path):
+        "Get the object referenced by a handle path (see do_inspect)"
+        if not self.frame:
+            raise RPCError("No current frame available to inspect")
+        scope = path[0]
+        obj = self.frame_locals if scope == 1 else self.frame.f_globals
+        for kind, key in path[1:]:
+            if kind == 'k':
+                obj = obj[key]
+            elif kind == 't':
+                obj = obj[handle_key(key)]
+            elif kind == 'a':
+                obj = getattr(obj, key)
+            else:
+                obj = obj[key]      # list or tuple index
+        return obj
+
+    def _children(self, obj, start, count, scope=False):
+        """Return the number of items or attributes of obj, and a page of
+        them: (name, path step, value), the step is None for set members"""
+        end = start + count
+        if scope or isinstance(obj, dict):
+            children = []
+            for key, value in itertools.islice(iteritems(obj), start, end):
+                if scope:
+                    step = ['k', key]
+                elif isinstance(key, tuple):
+                    step = is_handle_key(key) and ['t', key] or None
+                else:
+                    step = is_handle_key(key) and ['k', key] or None
+                children.append((key if scope else saferepr(key), step,
+                                 value))
+            return len(obj), children
+        if isinstance(obj, (list, tuple)):
+            return len(obj), [("[%d]" % i, ['i', i], value)
+                              for i, value in enumerate(obj[start:end],
+                                                        start)]
+        if isinstance(obj, (set, frozenset)):
+            # no order: a position could be another member at the next stop
+            return len(obj), [("{%d}" % i, None, value) for i, value in
+                              enumerate(itertools.islice(obj, start, end),
+                                        start)]
+        try:
+            attrs = vars(obj)
+        except TypeError:
+            return 0, []
+        return len(attrs), [(name, ['a', name], value) for name, value in
+                            itertools.islice(iteritems(attrs), start, end)]
+
+    def _expandable(self, value):
+        "Return True if a value has children (do not list them yet)"
+        if isinstance(value, string_types):
+            return False
+        if isinstance(value, (dict, list, tuple, set, frozenset)):
+            return len(value) > 0
+        try:
+            return bool(vars(value))
+        except TypeError:
+            return False
+
     def get_autocomplete_list(self, expression):
         "Return list of auto-completion options for expression"
         try:
@@ -468,17 +1223,57 @@ class Qdb(bdb.Bdb):
     def set_params(self, params):
         "Set parameters for interaction"
         self.params.update(params)
+        self.just_my_code = self.params.get('just_my_code', False)
+
+    def set_codec(self, name):
+        "Set the codec used to send messages (and accept it when received)"
+        if not hasattr(self.pipe, 'set_codec'):
+            raise RPCError("Codecs not supported by the connection")
+        self.pipe.set_codec(name)
+
+    def set_compression(self, threshold):
+        "Compress the messages sent bigger than threshold bytes (or None)"
+        if not hasattr(self.pipe, 'set_compression'):
+            raise RPCError("Compression not supported by the connection")
+        self.pipe.set_compression(threshold)
+
+    def get_stats(self):
+        "Return the protocol statistics of the connection (see stats)"
+        return dict(getattr(self.pipe, 'stats', {}))
+
+    def do_batch(self, calls):
+        """Execute several calls ({'method', 'args', 'kwargs'}) in order,
+        return a list of {'result', 'error'} (one message, one interaction).
+        The calls after one that resumes the program (i.e. do_continue) are
+        not executed: the frame they would use is gone"""
+        results = []
+        waiting = self.waiting
+        for call in calls:
+            response = {'result': None, 'error': None}
+            if waiting and not self.waiting:
+                response['error'] = {'code': 0, 'message':
+                                     "Not executed: the program resumed"}
+            else:
+                try:
+                    method = getattr(self, call['method'])
+                    response['result'] = method(*call.get('args', ()),
+                                                **call.get('kwargs') or {})
+                except Exception as e:
+                    response['error'] = {'code': 0, 'message': str(e)}
+            results.append(response)
+        return results
 
     def displayhook(self, obj):
         """Custom displayhook for the do_exec which prevents
         assignment of the _ variable in the builtins.
         """
-        self.displayhook_value = repr(obj)
+        self.displayhook_value = saferepr(obj, CONSOLE_REPR_CHARS)
 
     def reset(self):
         bdb.Bdb.reset(self)
         self.waiting = False
         self.frame = None
+        self.scopes_frame = None
 
     def post_mortem(self, info=None):
         "Debug an un-handled python exception"
@@ -513,8 +1308,8 @@ class Qdb(bdb.Bdb):
     def readline(self):
         "Replacement for stdin.readline()"
         msg = {'method': 'readline', 'args': (), 'id': self.i}
-        self.pipe.send(msg)
-        msg = self.pipe.recv()
+        self.send(msg)
+        msg = self.recv()
         self.i += 1
         return msg['result']
 
@@ -526,15 +1321,25 @@ class Qdb(bdb.Bdb):
         return lines
 
     def write(self, text):
-        "Replacement for stdout.write()"
-        msg = {'method': 'write', 'args': (str(text), ), 'id': None}
-        self.pipe.send(msg)
+        "Replacement for stdout.write() (buffered, see flush_output)"
+        text = str(text)
+        with self.send_lock:
+            # keep the output in order with the logpoint messages
+            self.flush_log()
+            self.output_buffer.append(text)
+            self.output_size += len(text)
+            if self.output_size >= OUTPUT_BATCH_SIZE:
+                self.flush_output()
+            elif not self.output_due:
+                self.output_due = time.time() + OUTPUT_BATCH_TIME
+                self._schedule_flush()
         
     def writelines(self, l):
-        map(self.write, l)
+        for text in l:
+            self.write(text)
 
     def flush(self):
-        pass
+        self.flush_output()
 
     def isatty(self):
         return 0
@@ -566,6 +1371,67 @@ class RPCError(RuntimeError):
     "Remote Error (not user exception)"
     pass
 
+
+class Future(object):
+    "Pending result of a remote call (see Frontend.call_async)"
+
+    def __init__(self, frontend, id):
+        self.frontend = frontend
+        self.id = id
+        self.done = False
+        self.value = self.error = None
+        self.received = self.total = 0     # streamed response progress
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def set_response(self, response):
+        self.value = response.get('result')
+        self.error = response.get('error')
+        with self.lock:
+            self.done = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback(future) when the response arrives (from the thread
+        that reads it), or now if it already did"""
+        with self.lock:
+            if not self.done:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self):
+        "Wait for the response (processing other messages), return or raise"
+        self.frontend.wait(self)
+        if self.error:
+            raise RPCError(self.error['message'])
+        return self.value
+
+    def cancel(self):
+        """Ask the backend to stop sending the response, or to interrupt a
+        console statement (result raises then)"""
+        if not self.done:
+            self.frontend.cancel(self.id)
+
+
+class Batch(object):
+    "Calls collected to be sent in a single message (see Frontend.batch)"
+
+    def __init__(self, frontend):
+        self.frontend = frontend
+        self.calls = []
+
+    def add(self, method, *args, **kwargs):
+        "Append a call, return its index in the results"
+        self.calls.append((method, args, kwargs))
+        return len(self.calls) - 1
+
+    def send(self):
+        "Execute the calls (in order), return their results"
+        return self.frontend.batch(self.calls)
+
     
 class Frontend(object):
     "Qdb generic Frontend interface"
@@ -574,8 +1440,14 @@ class Frontend(object):
         self.i = 1
         self.pipe = pipe
         self.notifies = []
+        # only one thread reads (and dispatches) messages at a time, the
+        # responses are matched with the calls waiting for them by id:
         self.read_lock = threading.RLock()
         self.write_lock = threading.RLock()
+        self.pending = {}   # request id: Future
+        # codecs supported by the backend (sent at startup, old ones don't)
+        self.remote_codecs = ()
+        self.remote_compressions = ()
 
     def recv(self):
         self.read_lock.acquire()
@@ -609,34 +1481,65 @@ class Frontend(object):
         "Console input/rawinput"
         raise NotImplementedError
 
+    def log(self, messages):
+        "Logpoint messages: list of (filename, lineno, text)"
+        raise NotImplementedError
+
+    def progress(self, id, received, total):
+        "Bytes received of a streamed response (the last when it is done)"
+        pass
+
     def run(self):
         "Main method dispatcher (infinite loop)"
         if self.pipe:
-            if not self.notifies:
-                # wait for a message...
-                request = self.recv()
-            else:
-                # process an asyncronus notification received earlier 
-                request = self.notifies.pop(0)
-            return self.process_message(request)
+            with self.read_lock:
+                if not self.notifies:
+                    # wait for a message...
+                    request = self.recv()
+                else:
+                    # process an asyncronus notification received earlier 
+                    request = self.notifies.pop(0)
+                return self.process_message(request)
     
     def process_message(self, request):
         if request:
             result = None
-            if request.get("error"):
+            if 'result' in request and request.get('id'):
+                # response to a call (maybe from another thread)
+                future = self.pending.pop(request['id'], None)
+                if future is None:
+                    print("DEBUGGER wrong packet received: unknown id",
+                          request['id'])
+                else:
+                    future.set_response(request)
+                    if future.total:
+                        self.progress(future.id, future.total, future.total)
+            elif request.get("error"):
                 # it is not supposed to get an error here
                 # it should be raised by the method call
                 raise RPCError(res['error']['message'])
             elif request.get('method') == 'interaction':
                 self.interaction(*request.get("args"), **request.get("kwargs"))
             elif request.get('method') == 'startup':
+                kwargs = request.get('kwargs') or {}
+                self.remote_codecs = kwargs.get('codecs', ())
+                self.remote_compressions = kwargs.get('compressions', ())
                 self.startup()
             elif request.get('method') == 'exception':
                 self.exception(*request['args'])
             elif request.get('method') == 'write':
                 self.write(*request.get("args"))
+            elif request.get('method') == 'log':
+                self.log(*request.get("args"))
             elif request.get('method') == 'readline':
                 result = self.readline()
+            elif request.get('method') == 'chunk':
+                # part of a big response received (see send_chunked)
+                id, received, total = request['args']
+                future = self.pending.get(id)
+                if future is not None:
+                    future.received, future.total = received, total
+                self.progress(id, received, total)
             if result:
                 response = {'version': '1.1', 'id': request.get('id'), 
                         'result': result, 
@@ -646,25 +1549,55 @@ class Frontend(object):
 
     def call(self, method, *args):
         "Actually call the remote method (inside the thread)"
-        req = {'method': method, 'args': args, 'id': self.i}
-        self.send(req)
-        self.i += 1  # increment the id
-        while 1:
-            # wait until command acknowledge (response id match the request)
-            res = self.recv()
-            if 'id' not in res or not res['id']:
-                # nested notification received (i.e. write)! process it!
-                self.process_message(res)
-            elif 'result' not in res:
-                # nested request received (i.e. readline)! process it!
-                self.process_message(res)
-            elif long(req['id']) != long(res['id']):
-                print("DEBUGGER wrong packet received: expecting id", req['id'], res['id'])
-                # protocol state is unknown
-            elif 'error' in res and res['error']:
-                raise RPCError(res['error']['message'])
+        return self.call_async(method, *args).result()
+
+    def call_async(self, method, *args):
+        "Send a request without waiting for the response (returns a Future)"
+        with self.write_lock:
+            future = Future(self, self.i)
+            self.i += 1  # increment the id
+            # registered first: the response could be read by another thread
+            self.pending[future.id] = future
+            self.send({'method': method, 'args': args, 'id': future.id})
+        return future
+
+    def call_all(self, calls, window=PIPELINE_WINDOW):
+        """Pipeline several calls (method, args...), return their results
+        (the first error is raised once all the responses arrived)"""
+        futures = []
+        for i, call in enumerate(calls):
+            if i >= window:
+                self.wait(futures[i - window])
+            futures.append(self.call_async(*call))
+        for future in futures:
+            self.wait(future)
+        return [future.result() for future in futures]
+
+    def new_batch(self):
+        "Start collecting calls to send them together (see Batch)"
+        return Batch(self)
+
+    def batch(self, calls):
+        """Send several calls (method, args, kwargs) in one message, executed
+        in order by the backend: return their results (RPCError instances
+        for the ones that failed, nothing is raised)"""
+        requests = [{'method': method, 'args': args, 'kwargs': kwargs}
+                    for method, args, kwargs in calls]
+        results = []
+        for response in self.call('do_batch', requests):
+            if response['error']:
+                results.append(RPCError(response['error']['message']))
             else:
-                return res['result']
+                results.append(response['result'])
+        return results
+
+    def wait(self, future):
+        "Read and process messages until the response of the call arrives"
+        while not future.done:
+            with self.read_lock:
+                # another thread could have read it while this one waited
+                if not future.done:
+                    self.process_message(self.recv())
 
     def do_step(self, arg=None):
         "Execute the current line, stop at the first possible occasion"
@@ -703,6 +1636,14 @@ class Frontend(object):
         "List all the locals and globals variables (string representation)"
         return self.call('do_environment')
 
+    def do_scopes(self):
+        "List the scopes (locals with their first page, globals) handles"
+        return self.call('do_scopes')
+
+    def do_inspect(self, handle, start=0, count=INSPECT_PAGE):
+        "Get a page of the children of a variable (by handle)"
+        return self.call('do_inspect', handle, start, count)
+
     def do_list(self, arg=None):
         "List source code for the current file"
         return self.call('do_list', arg)
@@ -711,9 +1652,16 @@ class Frontend(object):
         "Read and send a local filename"
         return self.call('do_read', filename)
 
-    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None):
-        "Set a breakpoint at filename:breakpoint"
-        self.call('do_set_breakpoint', filename, lineno, temporary, cond)
+    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None,
+                          ignore=0, every=0):
+        """Set a breakpoint at filename:breakpoint
+        (optional condition, ignore the first hits or stop every Nth hit)"""
+        self.call('do_set_breakpoint', filename, lineno, temporary, cond,
+                  ignore, every)
+
+    def do_set_logpoint(self, filename, lineno, template, cond=None):
+        "Set a logpoint (print the template, like 'x={x}', without stopping)"
+        return self.call('do_set_logpoint', filename, lineno, template, cond)
 
     def do_clear_breakpoint(self, filename, lineno):
         "Remove a breakpoint at filename:breakpoint"
@@ -721,7 +1669,7 @@ class Frontend(object):
 
     def do_clear_file_breakpoints(self, filename):
         "Remove all breakpoints at filename"
-        self.call('do_clear_breakpoints', filename, lineno)
+        self.call('do_clear_file_breakpoints', filename)
         
     def do_list_breakpoint(self):
         "List all breakpoints"
@@ -750,6 +1698,48 @@ class Frontend(object):
         req = {'method': 'set_params', 'args': (params, )}
         self.send(req)
 
+    def cancel(self, id):
+        "Stop a streamed response (the call raises RPCError: Cancelled)"
+        req = {'method': 'cancel', 'args': (id, ), 'id': None}
+        self.send(req)
+
+    def set_codec(self, name):
+        "Switch both sides of the connection to the given codec"
+        # the other side may answer with it as soon as it gets the request
+        self.pipe.accept_codec(name)
+        req = {'method': 'set_codec', 'args': (name, )}
+        self.send(req)
+        self.pipe.set_codec(name)
+
+    def negotiate_codec(self):
+        "Use a binary codec if both sides support it (else keep JSON)"
+        local = getattr(self.pipe, 'codecs', ())
+        for name in local:
+            if name != 'json' and name in self.remote_codecs:
+                self.set_codec(name)
+                return name
+        return 'json'
+
+    def set_compression(self, threshold):
+        "Compress the messages bigger than threshold bytes, both ways"
+        self.pipe.accept_compression()
+        req = {'method': 'set_compression', 'args': (threshold, )}
+        self.send(req)
+        self.pipe.set_compression(threshold)
+
+    def negotiate_compression(self, threshold):
+        "Compress the big messages if both sides support zlib"
+        if 'zlib' in getattr(self.pipe, 'compressions', ()) and \
+           'zlib' in self.remote_compressions:
+            self.set_compression(threshold)
+            return True
+        return False
+
+    def get_stats(self):
+        "Protocol statistics of both sides of the connection"
+        return {'frontend': dict(getattr(self.pipe, 'stats', {})),
+                'backend': self.call('get_stats')}
+
 
 def f(pipe):
     "test function to be debugged"
@@ -820,8 +1810,12 @@ def connect(host="localhost", port=6000, authkey='secret password'):
         conn.close()
 
 
-def main(host='localhost', port=6000, authkey=b'secret password'):
-    "Debug a script and accept a remote frontend"
+def main(host='localhost', port=6000, authkey=b'secret password',
+         engine='settrace', address=None, ready_fd=None):
+    """Debug a script and accept a remote frontend
+    (at host:port, or at address: 'unix:PATH', 'unix:' or 'fd:N', see
+    json_serializer.parse_address).  If ready_fd is given, the address is
+    written there once listening, so the frontend can connect right away"""
     
     if not sys.argv[1:] or sys.argv[1] in ("--help", "-h"):
         print("usage: pdb.py scriptfile [arg] ...")
@@ -838,15 +1832,29 @@ def main(host='localhost', port=6000, authkey=b'secret password'):
     sys.path[0] = os.path.dirname(mainpyfile)
 
     #from multiprocessing.connection import Listener
-    from json_serializer import JsonListener
-    address = (host, port)     # family is deduced to be 'AF_INET'
-    listener = JsonListener(address, authkey=authkey)
-    print("qdb debugger backend: waiting for connection at", address)
-    conn = listener.accept()
-    print('qdb debugger backend: connected to', listener.last_accepted)
+    from json_serializer import JsonListener, JsonClient, parse_address, \
+                                format_address
+    address = parse_address(address) or (host, int(port))
+    if isinstance(address, int):
+        # inherited socket, already connected to the frontend
+        listener = None
+        conn = JsonClient(address)
+    else:
+        # family is deduced from the address: 'AF_INET' or 'AF_UNIX'
+        listener = JsonListener(address, authkey=authkey)
+        print("qdb debugger backend: waiting for connection at",
+              listener.address)
+        if ready_fd:
+            # readiness notification (a line with the address, then EOF)
+            line = format_address(listener.address) + "\n"
+            os.write(int(ready_fd), line.encode("utf-8"))
+            os.close(int(ready_fd))
+        conn = listener.accept()
+        print('qdb debugger backend: connected to', listener.last_accepted)
 
     # create the backend
-    qdb = Qdb(conn, redirect_stdio=True, allow_interruptions=True)
+    qdb = Qdb(conn, redirect_stdio=True, allow_interruptions=True,
+              engine=engine)
     try:
         print("running", mainpyfile)
         qdb._runscript(mainpyfile)
@@ -863,8 +1871,16 @@ def main(host='localhost', port=6000, authkey=b'secret password'):
         qdb.post_mortem(info)
         print("Program terminated!")
     finally:
+        # send the last (buffered) output, then stop redirecting to the pipe
+        try:
+            qdb.flush_output()
+        except (IOError, OSError, EOFError):
+            pass    # the frontend is gone
+        sys.stdin, sys.stdout, sys.stderr = (sys.__stdin__, sys.__stdout__,
+                                             sys.__stderr__)
         conn.close()
-        listener.close()
+        if listener:
+            listener.close()
         print("qdb debbuger backend: connection closed")
 
 
@@ -891,7 +1907,9 @@ def quit():
     "Remove trace and quit"
     global qdb, listener, conn
     if qdb:
-        sys.settrace(None)
+        qdb.flush_log()
+        qdb.flush_output()
+        qdb.stop_trace()
         qdb = None
     if conn:
         conn.close()
@@ -906,7 +1924,7 @@ if __name__ == '__main__':
         test()
     # Check environment for configuration parameters:
     kwargs = {}
-    for param in 'host', 'port', 'authkey':
+    for param in 'host', 'port', 'authkey', 'engine':
        if 'QDB_%s' % param.upper() in os.environ:
             kwargs[param] = os.environ['QDB_%s' % param.upper()]
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"Fork server for the Qdb debugger backend (preloaded imports, fast restarts)"
+
+# Importing a big application can take seconds, on every debug session.
+# This server imports qdb and the modules listed in QDB_PRELOAD (comma
+# separated) once, then forks a child per session that runs qdb.main on the
+# script, with those modules already in sys.modules (so their module level
+# code is not traced: breakpoints there are not hit).
+# Requests (JSON RPC like) thru the connection given in QDB_ADDRESS:
+#   run(script, args, cwd) -> [pid, address of the session, already ready]
+#   kill(pid)
+#   quit()
+# POSIX only (os.fork).
+
+import atexit
+import os
+import signal
+import sys
+import threading
+import traceback
+
+import qdb
+from json_serializer import JsonClient
+
+
+def preload(names):
+    "Import the modules (the current directory is the application's one)"
+    if '' not in sys.path:
+        sys.path.insert(0, '')
+    for name in names:
+        try:
+            __import__(name)
+        except Exception as e:
+            print("qdb fork server: cannot preload %s: %s" % (name, e))
+
+
+def shutdown():
+    "Wait for the non daemon threads, then run the atexit handlers"
+    current = threading.current_thread()
+    for thread in threading.enumerate():
+        if thread is not current and not thread.daemon:
+            try:
+                thread.join()
+            except Exception:
+                traceback.print_exc()
+    try:
+        atexit._run_exitfuncs()
+    except Exception:
+        traceback.print_exc()
+
+
+class ForkServer(object):
+    "Fork a debug session (qdb.main) per run request"
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.children = set()
+
+    def serve(self):
+        "Process the requests until quit (or the frontend is gone)"
+        while True:
+            try:
+                request = self.conn.recv()
+            except (EOFError, IOError, OSError):
+                break
+            response = {'id': request.get('id'), 'result': None,
+                        'error': None}
+            try:
+                method = getattr(self, 'do_%s' % request['method'])
+                response['result'] = method(*request['args'])
+            except Exception as e:
+                response['error'] = {'code': 0, 'message': str(e)}
+            self.conn.send(response)
+            self.reap()
+            if request['method'] == 'quit':
+                break
+        for pid in list(self.children):
+            self.do_kill(pid)
+
+    def do_run(self, script, args=(), cwd=None):
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child: the debug session (never returns to the server loop)
+            os.close(ready_r)
+            self.conn.close()
+            status = 0
+            try:
+                if cwd:
+                    os.chdir(cwd)
+                sys.argv = [sys.argv[0], script] + list(args)
+                qdb.main(address='unix:', ready_fd=ready_w)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                # os._exit skips the interpreter shutdown: do it like it
+                shutdown()
+                # os._exit doesn't flush the buffers of the streams
+                for stream in (sys.stdout, sys.stderr,
+                               sys.__stdout__, sys.__stderr__):
+                    try:
+                        stream.flush()
+                    except Exception:
+                        pass    # i.e. closed, or the session connection
+                os._exit(status)
+        os.close(ready_w)
+        ready = os.fdopen(ready_r, 'rb')
+        try:
+            # the session is listening when its address is written
+            line = ready.readline().decode('utf-8').strip()
+        finally:
+            ready.close()
+        if not line:
+            os.waitpid(pid, 0)
+            raise RuntimeError("Debug session failed to start")
+        self.children.add(pid)
+        return [pid, line]
+
+    def do_kill(self, pid):
+        if pid not in self.children:
+            raise ValueError("Unknown debug session: %s" % pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass    # already finished
+        self.children.discard(pid)
+
+    def do_quit(self):
+        pass
+
+    def reap(self):
+        "Collect the sessions that finished (no zombies)"
+        for pid in list(self.children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                done = pid
+            if done:
+                self.children.discard(pid)
+
+
+def main(address=None, preload_modules=''):
+    preload([name.strip() for name in preload_modules.split(',')
+             if name.strip()])
+    conn = JsonClient(address)
+    try:
+        ForkServer(conn).serve()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    # reimport (the sessions replace the __main__ namespace with the script)
+    import qdb_forkserver
+    qdb_forkserver.main(os.environ['QDB_ADDRESS'],
+                        os.environ.get('QDB_PRELOAD', ''))
@@ -7,7 +7,7 @@ if __name__ == '__main__':
         test()
     # Check environment for configuration parameters:
     kwargs = {}
-    for param in 'host', 'port', 'authkey':
+    for param in 'host', 'port', 'authkey', 'engine', 'address', 'ready_fd':
        if 'QDB_%s' % param.upper() in os.environ:
             kwargs[param] = os.environ['QDB_%s' % param.upper()]
 
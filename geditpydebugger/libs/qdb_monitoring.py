@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"sys.monitoring (PEP 669) tracing engine for the Qdb debugger backend"
+
+# Qdb is a bdb.Bdb subclass, so the stepping state (botframe, stopframe,
+# returnframe, stoplineno) and the stop decisions (stop_here, break_here)
+# are kept as they are.  This engine only replaces sys.settrace as the source
+# of the call/line/return/exception events, and asks the interpreter for as
+# few of them as possible:
+# - continue: LINE only on code objects that contain a breakpoint
+# - next / return: LINE and PY_RETURN on the code of the stop frame too
+# - step: every event, on every code object
+# Anything else returns DISABLE, so it runs at native speed afterwards.
+
+import sys
+
+try:
+    monitoring = sys.monitoring
+except AttributeError:
+    monitoring = None   # Python < 3.12
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+
+class MonitoringTracer(object):
+    "Feed a Qdb instance with sys.monitoring events (Python 3.12+)"
+
+    def __init__(self, debugger, tool_id=None):
+        if monitoring is None:
+            raise RuntimeError("sys.monitoring engine requires Python 3.12+")
+        self.debugger = debugger
+        self.tool_id = tool_id if tool_id is not None else monitoring.DEBUGGER_ID
+        self.active = False
+        self.thread = None      # only the debugged thread stops
+        self.stepping = True    # step mode: every event is needed
+        self.stop_code = None   # code of the frame for next / return
+        self.codes = {}         # canonic filename: code objects seen
+        self.seen = set()       # code objects seen
+        self.local_events = {}  # code object: local events currently set
+
+    def start(self):
+        "Claim the debugger tool id and install the event callbacks"
+        if self.active:
+            return
+        monitoring.use_tool_id(self.tool_id, "qdb")
+        for event, callback in self._callbacks():
+            monitoring.register_callback(self.tool_id, event, callback)
+        self.thread = get_ident()
+        self.active = True
+        self.update()
+
+    def stop(self):
+        "Remove every event and release the tool id"
+        if not self.active:
+            return
+        self.active = False
+        monitoring.set_events(self.tool_id, 0)
+        for code in self.local_events:
+            monitoring.set_local_events(self.tool_id, code, 0)
+        self.local_events = {}
+        for event, callback in self._callbacks():
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+
+    def _callbacks(self):
+        events = monitoring.events
+        return ((events.PY_START, self.on_start),
+                (events.PY_RESUME, self.on_start),
+                (events.PY_RETURN, self.on_return),
+                (events.PY_YIELD, self.on_return),
+                (events.LINE, self.on_line),
+                (events.RAISE, self.on_raise))
+
+    def register(self, code):
+        "Remember a code object, so breakpoints set later can arm it"
+        if code in self.seen:
+            return False
+        self.seen.add(code)
+        filename = self.debugger.canonic(code.co_filename)
+        self.codes.setdefault(filename, set()).add(code)
+        return True
+
+    def update(self):
+        "Select the events for the current stepping mode and breakpoints"
+        if not self.active:
+            return
+        dbg = self.debugger
+        events = monitoring.events
+        # code that is already running never gets a PY_START event:
+        frame = sys._current_frames().get(self.thread)
+        while frame is not None:
+            self.register(frame.f_code)
+            frame = frame.f_back
+        wanted = {}
+        if dbg.quitting:
+            global_events = 0
+            self.stepping = False
+            self.stop_code = None
+        elif dbg.botframe is None or dbg.stopframe is None:
+            # step (or not started yet): stop anywhere
+            global_events = (events.PY_START | events.PY_RESUME |
+                             events.PY_RETURN | events.PY_YIELD |
+                             events.LINE | events.RAISE)
+            self.stepping = True
+            self.stop_code = None
+        else:
+            self.stepping = False
+            if dbg.stopframe is dbg.botframe and dbg.stoplineno == -1:
+                # continue
+                self.stop_code = None
+            else:
+                # next / return: only the stop frame (and breakpoints)
+                self.stop_code = dbg.stopframe.f_code
+                wanted[self.stop_code] = (events.LINE | events.PY_RETURN |
+                                          events.PY_YIELD)
+            global_events = 0
+            for filename, lines in dbg.bp_index.files.items():
+                if not lines:
+                    continue
+                # new code objects must be checked for breakpoints:
+                global_events = events.PY_START | events.PY_RESUME
+                for code in self.codes.get(filename, ()):
+                    if dbg.bp_index.code_breaks(code):
+                        wanted[code] = wanted.get(code, 0) | events.LINE
+        for code in set(self.local_events) | set(wanted):
+            if self.local_events.get(code, 0) != wanted.get(code, 0):
+                monitoring.set_local_events(self.tool_id, code,
+                                            wanted.get(code, 0))
+        self.local_events = wanted
+        monitoring.set_events(self.tool_id, global_events)
+        # re-enable the locations disabled under the previous mode
+        monitoring.restart_events()
+
+    def wake(self):
+        "Get a LINE event soon (called by the reader thread on new requests)"
+        if not self.active:
+            return
+        events = monitoring.get_events(self.tool_id)
+        monitoring.set_events(self.tool_id, events | monitoring.events.LINE)
+        monitoring.restart_events()
+
+    def poll(self):
+        "Process the pending requests, then select the events again"
+        self.debugger.process_pending()
+        self.update()
+
+    # event callbacks (called by the interpreter):
+
+    def on_start(self, code, instruction_offset):
+        if self.register(code) and not self.stepping:
+            if self.debugger.bp_index.code_breaks(code):
+                events = self.local_events.get(code, 0) | monitoring.events.LINE
+                monitoring.set_local_events(self.tool_id, code, events)
+                self.local_events[code] = events
+        if not self.stepping:
+            return monitoring.DISABLE
+        if get_ident() == self.thread:
+            self.debugger.dispatch_call(sys._getframe(1), None)
+
+    def on_line(self, code, line_number):
+        if get_ident() != self.thread:
+            return
+        dbg = self.debugger
+        if dbg.pending:
+            self.poll()
+        if code is self.stop_code or line_number in dbg.bp_index.lookup(code):
+            dbg.dispatch_line(sys._getframe(1))
+            return
+        if self.stepping:
+            frame = sys._getframe(1)
+            if not dbg.ignore_frame(frame):
+                dbg.dispatch_line(frame)
+                return
+        return monitoring.DISABLE
+
+    def on_return(self, code, instruction_offset, retval):
+        if get_ident() != self.thread:
+            return
+        dbg = self.debugger
+        stopframe = dbg.stopframe
+        dbg.dispatch_return(sys._getframe(1), retval)
+        if dbg.stopframe is not stopframe:
+            # 'next' finished the stop frame: step into the caller
+            self.update()
+
+    def on_raise(self, code, instruction_offset, exception):
+        # RAISE is not a local event: it cannot be DISABLEd
+        if not self.stepping or get_ident() != self.thread:
+            return
+        info = (type(exception), exception, exception.__traceback__)
+        self.debugger.dispatch_exception(sys._getframe(1), info)
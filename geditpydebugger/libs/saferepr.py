@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"Bounded repr for the Qdb debugger backend (variables, eval results...)"
+
+# repr() of a big object is computed in full before it can be truncated
+# (a list of millions of items just to show 255 characters), so:
+# - builtin scalars, strings and containers are written piece by piece,
+#   stopping as soon as the character budget is exhausted
+# - containers show at most maxitems elements and maxlevel nesting levels
+# - subclasses of them too, if their repr is the builtin one (or the one of
+#   OrderedDict, Counter, defaultdict)
+# - array-like objects (numpy) are summarized by shape and dtype if large
+# - anything else uses its __repr__, interrupted after a time limit (only
+#   in the main thread, where SIGALRM can be delivered)
+
+import signal
+import threading
+
+from py3compat import *
+
+try:
+    from collections import deque
+except ImportError:
+    deque = None
+
+try:
+    from collections import OrderedDict, Counter, defaultdict
+except ImportError:
+    OrderedDict = Counter = defaultdict = None
+
+try:
+    from array import array
+except ImportError:
+    array = None
+
+if PY3:
+    STRING_TYPES = (str, bytes, bytearray)
+else:
+    STRING_TYPES = (str, unicode, bytearray)
+
+
+class ReprTimeout(Exception):
+    "__repr__ didn't return in the time limit"
+
+
+class _Full(Exception):
+    "The character budget is exhausted"
+
+
+class _Writer(object):
+    "Accumulate text up to a number of characters"
+
+    def __init__(self, maxchars):
+        self.parts = []
+        self.left = maxchars
+
+    def write(self, text):
+        if len(text) > self.left:
+            self.parts.append(text[:self.left])
+            self.left = 0
+            raise _Full()
+        self.parts.append(text)
+        self.left -= len(text)
+
+
+def is_main_thread():
+    current = threading.current_thread()
+    if hasattr(threading, 'main_thread'):
+        return current is threading.main_thread()
+    return current.name == 'MainThread'
+
+
+def call_with_timeout(function, arg, timeout):
+    "Call function(arg), raising ReprTimeout after timeout seconds"
+    if not timeout or not hasattr(signal, 'setitimer') or \
+       not is_main_thread():
+        return function(arg)
+
+    def alarm(signum, frame):
+        raise ReprTimeout()
+
+    previous = signal.signal(signal.SIGALRM, alarm)
+    delay, interval = signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return function(arg)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        if delay:
+            # restore the program's own timer (approximately)
+            signal.setitimer(signal.ITIMER_REAL, delay, interval)
+
+
+class SafeRepr(object):
+    "Callable repr replacement with character, item, level and time budgets"
+
+    def __init__(self, maxchars=255, maxitems=30, maxlevel=3, timeout=0.5):
+        self.maxchars = maxchars
+        self.maxitems = maxitems
+        self.maxlevel = maxlevel
+        self.timeout = timeout
+
+    def __call__(self, obj, maxchars=None):
+        out = _Writer(maxchars or self.maxchars)
+        try:
+            self._repr(obj, self.maxlevel, out)
+        except _Full:
+            return ''.join(out.parts) + '...'
+        except Exception as e:
+            # i.e. a container changed size during iteration
+            return "<%s object at %#x (repr failed: %s)>" % (
+                        type(obj).__name__, id(obj), type(e).__name__)
+        return ''.join(out.parts)
+
+    def _repr(self, obj, level, out):
+        cls = type(obj)
+        if obj is None or cls in (bool, float, complex):
+            out.write(repr(obj))
+        elif cls in integer_types:
+            # big numbers: ~0.3 digits per bit (str() of them is quadratic)
+            if obj.bit_length() > out.left * 4:
+                out.write("<%s of %d bits>" % (cls.__name__, obj.bit_length()))
+            else:
+                out.write(repr(obj))
+        elif cls in STRING_TYPES:
+            # a repr one character longer than the budget is enough
+            out.write(repr(obj[:out.left + 1]))
+        elif cls is list:
+            self._repr_items(obj, level, out, '[', ']')
+        elif cls is tuple:
+            self._repr_items(obj, level, out, '(', len(obj) == 1 and ',)' or ')')
+        elif cls in (set, frozenset):
+            if not obj:
+                out.write('%s()' % cls.__name__)
+            elif cls is set:
+                self._repr_items(obj, level, out, '{', '}')
+            else:
+                self._repr_items(obj, level, out, 'frozenset({', '})')
+        elif cls is dict:
+            self._repr_items(iteritems(obj), level, out, '{', '}',
+                             mapping=True)
+        elif isinstance(obj, (dict, list, tuple, set, frozenset)):
+            self._repr_subclass(obj, cls, level, out)
+        elif deque is not None and cls is deque:
+            self._repr_items(obj, level, out, 'deque([', '])')
+        elif array is not None and cls is array:
+            self._repr_items(obj, level, out, "array('%s', [" % obj.typecode,
+                             '])')
+        elif self._is_large_array(obj):
+            out.write('<%s shape=%s dtype=%s>' % (cls.__name__, obj.shape,
+                                                 obj.dtype))
+        else:
+            self._repr_fallback(obj, out)
+
+    def _repr_subclass(self, obj, cls, level, out):
+        # the class that defines the repr: bounded if it is a known one
+        owner = [base for base in cls.__mro__ if '__repr__' in vars(base)][0]
+        name = cls.__name__
+        if owner is dict:
+            self._repr_items(iteritems(obj), level, out, '{', '}',
+                             mapping=True)
+        elif owner is list:
+            self._repr_items(obj, level, out, '[', ']')
+        elif owner is tuple:
+            self._repr_items(obj, level, out, '(',
+                             len(obj) == 1 and ',)' or ')')
+        elif not obj and owner in (set, frozenset, OrderedDict, Counter):
+            out.write('%s()' % name)
+        elif owner in (set, frozenset):
+            self._repr_items(obj, level, out, '%s({' % name, '})')
+        elif owner in (OrderedDict, Counter):
+            # (Counter items in insertion order, not sorted by count)
+            self._repr_items(iteritems(obj), level, out, '%s({' % name,
+                             '})', mapping=True)
+        elif owner is defaultdict and defaultdict is not None:
+            out.write('%s(' % name)
+            self._repr(obj.default_factory, level - 1, out)
+            self._repr_items(iteritems(obj), level, out, ', {', '})',
+                             mapping=True)
+        else:
+            self._repr_fallback(obj, out)
+
+    def _repr_items(self, items, level, out, start, end, mapping=False):
+        out.write(start)
+        if level <= 0:
+            out.write('...')
+        else:
+            for i, item in enumerate(items):
+                if i:
+                    out.write(', ')
+                if i >= self.maxitems:
+                    out.write('...')
+                    break
+                if mapping:
+                    self._repr(item[0], level - 1, out)
+                    out.write(': ')
+                    self._repr(item[1], level - 1, out)
+                else:
+                    self._repr(item, level - 1, out)
+        out.write(end)
+
+    def _is_large_array(self, obj):
+        # numpy (and look-alikes): do not import it, just check the attributes
+        if not hasattr(type(obj), '__array__'):
+            return False
+        try:
+            return obj.size > self.maxitems and \
+                   isinstance(obj.shape, tuple) and obj.dtype is not None
+        except Exception:
+            return False
+
+    def _repr_fallback(self, obj, out):
+        try:
+            text = call_with_timeout(repr, obj, self.timeout)
+        except ReprTimeout:
+            text = "<%s object at %#x (repr timed out)>" % (
+                        type(obj).__name__, id(obj))
+        except Exception as e:
+            text = "<%s object at %#x (repr failed: %s)>" % (
+                        type(obj).__name__, id(obj), type(e).__name__)
+        out.write(text)
+
+
+# default instance (short values, as shown in the variables tree)
+saferepr = SafeRepr()
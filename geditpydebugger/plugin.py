@@ -1,55 +1,45 @@
 import os
-import re
 import sys
-
-
 import time
-import subprocess
+
 MODULE_DIRECTORY = os.path.dirname(__file__)
 
 sys.path.append(os.path.join(MODULE_DIRECTORY, "libs"))
 
 QDB_LAUNCHER_PATH = os.path.join(MODULE_DIRECTORY, "libs", "qdb_launcher.py")
+QDB_FORKSERVER_PATH = os.path.join(MODULE_DIRECTORY, "libs", "qdb_forkserver.py")
 
-from .debugger_frontend import CallbackFrontend
-from .components import ContextBox, InterpretersDialog
-from .breakpoint import LineBreakpoint
-from .image_utils import get_pixbuf_from_file, CURRENT_STEP_PIXBUF, BREAKPOINT_PIXBUF, DEBUGGER_CONSOLE_IMAGE
+# fork server mode: the modules listed (comma separated) are imported once,
+# each debug session (and restart) is a fork of that warm process
+FORKSERVER_PRELOAD = os.environ.get("GQDB_PRELOAD")
 
-from distutils.version import StrictVersion as V
-from gi.repository import GObject, Gtk, GLib, Gdk, GtkSource, Gedit, Gio
+# compress the debugger messages bigger than these bytes (i.e. when the
+# backend is reached thru an SSH tunnel), by default only for remote hosts
+COMPRESS_THRESHOLD = os.environ.get("GQDB_COMPRESS")
 
-def get_version_from_str(version_str):
-    return re.search('\d+(\.\d+)+', str(version_str)).group(0)
-    
-# Get the gedit version
-proc = subprocess.Popen('gedit --version', shell=True, 
-    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-(stdout, stderr) = proc.communicate()
-    
-GEDIT_VERSION = get_version_from_str(stdout)
-if not GEDIT_VERSION:
-    print("Could not determine Gedit version")
-else:
-    GEDIT_VERSION = V(GEDIT_VERSION)
+# longest time the debugger events are handled in a row (seconds), so a
+# flood of them (i.e. program output) doesn't freeze the editor
+DISPATCH_BUDGET = 0.02
 
-if GEDIT_VERSION < V("3.10"):
-    print("Gedit version not compatible. Version 3.10 or higher is required but %s detected." % GEDIT_VERSION)
-else:
-    print("Gedit version: %s" % GEDIT_VERSION)
+# lines kept in the debugger console output (10000 by default)
+SCROLLBACK_LINES = os.environ.get("GQDB_SCROLLBACK")
 
+# console statements running longer than these seconds are interrupted
+# (0: wait until they finish, Ctrl+C interrupts them anyway)
+EXEC_TIMEOUT = float(os.environ.get("GQDB_EXEC_TIMEOUT") or 10)
 
-PYTHON_RUNTIMES = []
-# Get the installed interpreters #TODO: do something less ugly
-for py in ['python2', 'python3']:
-    try:
-        out = subprocess.check_output("%s --version" % str(py), shell=True)
-        py_path = subprocess.check_output("which %s" % str(py), shell=True)
-        PYTHON_RUNTIMES.append([py, py_path.decode("utf-8").strip("\n")])
-    except subprocess.CalledProcessError as e:
-        print("Error: ", e)
+from qdb import RPCError, Future
+from .debugger_frontend import CallbackFrontend, ForkServer, launch
+from .components import ContextBox, InterpretersDialog
+from .breakpoint import LineBreakpoint
+from .interpreters import InterpreterFinder, project_interpreters
+from .image_utils import get_pixbuf_from_file, CURRENT_STEP_PIXBUF, BREAKPOINT_PIXBUF, DEBUGGER_CONSOLE_PIXBUF
+
+from gi.repository import GObject, Gtk, GLib, Gdk, GtkSource, Gedit, Gio
 
-print("Detected python runtimes: %s" % str(PYTHON_RUNTIMES))
+# nothing is run at startup: the interpreters are found (in a thread) the
+# first time the debug action is used, and then cached on disk
+INTERPRETERS = InterpreterFinder()
 
 
 class GqdbPluginActivatable(GObject.Object, Gedit.WindowActivatable):
@@ -62,22 +52,33 @@ class GqdbPluginActivatable(GObject.Object, Gedit.WindowActivatable):
         self._views = []
         self._debugging = False
         self._debugger = None
+        self._fork_server = None
+        self._session = None    # last script, interpreter, process or pid
+        self._events = None     # debugger events taken, not handled yet
         self._breakpoints = set()
         self._gui_handlers = {}
         self._action_group = None
         self._context_box = None
+        self._exec_timeout = None   # source id of the console timeout
 
     def do_activate(self):
         panel = self.window.get_bottom_panel()
-        self._context_box = ContextBox(self)
+        self._context_box = ContextBox(self, int(SCROLLBACK_LINES) if SCROLLBACK_LINES else None)
         self._gui_handlers = {'write': self._context_box.write_stdout,
                     'mark-current-line' : self.mark_current_line,
-                    'clear-interaction' : self._clear_interaction}
-
-        if GEDIT_VERSION < V("3.12"):
-            panel.add_item(self._context_box, "debuggerpanel", "Python debugger", DEBUGGER_CONSOLE_IMAGE)
-        else:
+                    'update-context' : self._context_box.update_context,
+                    'clear-interaction' : self._clear_interaction,
+                    'progress' : self.show_progress,
+                    'inspect-result' : self._context_box.inspect_done,
+                    'refresh-result' : self._context_box.set_context,
+                    'exec-result' : self.exec_done}
+
+        if hasattr(panel, "add_titled"):
+            # gedit >= 3.12 (a Gtk.Stack)
             panel.add_titled(self._context_box, "debuggerpanel", "Python debugger")
+        else:
+            image = Gtk.Image.new_from_pixbuf(get_pixbuf_from_file(DEBUGGER_CONSOLE_PIXBUF))
+            panel.add_item(self._context_box, "debuggerpanel", "Python debugger", image)
 
         panel.show_all()
         
@@ -114,9 +115,67 @@ class GqdbPluginActivatable(GObject.Object, Gedit.WindowActivatable):
         if self._debugger and self._debugger.attached:
             self._debugger.Quit()
 
+    def restart_cb(self):
+        "Terminate the debugged program and start it again"
+        if not self._session:
+            return
+        file_path, pythexec, proc, pid = self._session
+        if self._debugger:
+            self._debugger.detach()
+        if pid:
+            try:
+                self._fork_server.kill(pid)
+            except RPCError:
+                pass    # already finished
+        elif proc:
+            proc.kill()
+            proc.wait()
+        self._clear_interaction()
+        self.execute(file_path, pythexec)
+
     def do_exec(self, arg):
+        "Start a console statement: True if the result will come (exec_done)"
+        if self._debugger and self._debugger.attached:
+            ret = self._debugger.Exec(arg)
+            if not isinstance(ret, Future):
+                return ret
+            # stepping would wait for the statement (blocking the editor)
+            self._context_box.set_sensitive_buttons(False)
+            if EXEC_TIMEOUT:
+                self._exec_timeout = GLib.timeout_add(int(EXEC_TIMEOUT * 1000),
+                                                      self._exec_timed_out)
+            return True
+
+    def exec_done(self, result):
+        if self._exec_timeout is not None:
+            GLib.source_remove(self._exec_timeout)
+            self._exec_timeout = None
+        self._context_box.set_sensitive_buttons(self._debugging)
+        self._context_box.exec_done(result)
+
+    def cancel_exec(self):
+        if self._debugger:
+            self._debugger.CancelExec()
+
+    def _exec_timed_out(self):
+        self._exec_timeout = None
+        self._context_box.write_stdout("*** timeout (%gs), interrupting...\n" % EXEC_TIMEOUT)
+        self.cancel_exec()
+        return False
+
+    def do_refresh(self):
+        "Start getting the whole context (set when it comes), True if sent"
         if self._debugger and self._debugger.attached:
-            return self._debugger.Exec(arg)
+            return self._debugger.Refresh() is not None
+
+    def do_inspect(self, handle, start=0):
+        "Start getting a page of children (see inspect_done), True if sent"
+        if self._debugger and self._debugger.attached:
+            return self._debugger.Inspect(handle, start) is not None
+
+    def cancel_transfers(self):
+        if self._debugger:
+            self._debugger.CancelTransfers()
     
     def setDebugging(self, val):
         self._debugging = val
@@ -130,12 +189,11 @@ class GqdbPluginActivatable(GObject.Object, Gedit.WindowActivatable):
         self._handlers = None
         if self._debugger:
             self._debugger.Quit()
+        if self._fork_server:
+            self._fork_server.close()
         self.window.remove_action("gqdb")
         panel = self.window.get_bottom_panel()
         panel.remove(self._context_box)
-        if GEDIT_VERSION < V("3.10"):
-            manager = self.window.get_ui_manager()
-            manager.remove_ui(self._ui_id)
     
     def do_update_state(self):
         pass
@@ -239,58 +297,104 @@ class GqdbPluginActivatable(GObject.Object, Gedit.WindowActivatable):
         document.create_source_mark(None, "2", document.get_iter_at_line(lineno))
         self._context_box.set_context(context)
     
+    def show_progress(self, id, received, total):
+        "Show the transfer of a big response in the statusbar"
+        statusbar = self.window.get_statusbar()
+        context_id = statusbar.get_context_id("gqdb")
+        statusbar.remove_all(context_id)
+        if received < total:
+            statusbar.push(context_id, "Debugger: receiving %d of %d KiB "
+                           "(Escape in the variables to cancel)" % (
+                           received // 1024, total // 1024))
+
     def clear_markers(self):
         for doc in self.window.get_documents():
             start, end = doc.get_bounds()
             doc.remove_source_marks(start, end, "2")
                 
-    def _attach(self, retry=0):
-        if not self._debugger.attached:
-            if retry == 10:
-                raise Exception("Max retries error.")
-            try:
-                time.sleep(0.5)
-                self._debugger.attach()
-            except ConnectionRefusedError as e:
-                self._attach(retry+1)
+    def _notify(self):
+        "Process the debugger events in the main loop (called by its thread)"
+        GLib.idle_add(self._check_messages)
 
     def _check_messages(self):
-        while not self._debugger.messages_queue.empty():
-            method_name, data = self._debugger.messages_queue.get_nowait()
+        "Handle the events for a while, return True if some are left"
+        deadline = time.time() + DISPATCH_BUDGET
+        channel = self._debugger.events
+        while True:
+            if not self._events:
+                self._events = channel.take()
+                if not self._events:
+                    if channel.done():
+                        return False
+                    continue
+            method_name, data = self._events.popleft()
             # call the handler
             self._gui_handlers[method_name](*data)
-        while Gtk.events_pending():
-            Gtk.main_iteration_do(False)
-        return self._debugging
+            if time.time() > deadline:
+                # let gedit draw and handle input, continue when idle
+                return True
     
-    def execute(self, file_path):
-        # ask for interpreter
-        diag = InterpretersDialog(PYTHON_RUNTIMES)
+    def _get_fork_server(self, pythexec, cwd):
+        "Return the fork server for the interpreter (started if needed)"
+        server = self._fork_server
+        if server and (server.python != pythexec or not server.is_alive()):
+            server.close()
+            server = None
+        if not server:
+            preload = [name.strip() for name in FORKSERVER_PRELOAD.split(",")
+                       if name.strip()]
+            server = ForkServer([pythexec, "-u", QDB_FORKSERVER_PATH],
+                                cwd=cwd, preload=preload)
+            server.python = pythexec
+            self._fork_server = server
+        return server
+
+    def _choose_interpreter(self, file_path, interpreters):
+        "Ask for the interpreter (the project virtualenvs first), then run"
+        runtimes = project_interpreters(file_path)
+        paths = set(path for name, path in runtimes)
+        runtimes += [i for i in interpreters if i[1] not in paths]
+        diag = InterpretersDialog(runtimes)
         pythexec = diag.run()
+        if pythexec:
+            self.execute(file_path, pythexec)
+        return False
+
+    def execute(self, file_path, pythexec=None):
         if not pythexec:
+            # ask for interpreter (when they are found, in the main loop)
+            INTERPRETERS.get(lambda interpreters: GLib.idle_add(
+                self._choose_interpreter, file_path, interpreters))
             return
-        # poll messages from queue
         self.setDebugging(True)
-        GLib.timeout_add(100, self._check_messages)
-        self._debugger = CallbackFrontend(breakpoints=self._breakpoints)
+        threshold = int(COMPRESS_THRESHOLD) if COMPRESS_THRESHOLD else None
+        self._debugger = CallbackFrontend(breakpoints=self._breakpoints,
+                                          compress_threshold=threshold)
+        # messages are handled as soon as they arrive (no polling)
+        self._debugger.notify = self._notify
         self._debugger.init(cont=True)
         
         cdir, filen = os.path.split(file_path)
         if not cdir:
             cdir = "."
-        cwd = os.getcwd()
+        # interpreter started directly (no shell), with a private connection
+        # per session: the debuggee inherits one end of a socketpair, so it
+        # is ready as soon as it is spawned (no connection retries)
+        argv = [pythexec, "-u", QDB_LAUNCHER_PATH, file_path]
         try:
-            os.chdir(cdir)
-            cmd = pythexec + " -u " + QDB_LAUNCHER_PATH + ' ' + file_path
-            print("Executing: ", cmd)
-            proc = subprocess.Popen([cmd], shell=True, close_fds=True)
-            retries = 0
-            self._attach()
+            if FORKSERVER_PRELOAD is not None:
+                server = self._get_fork_server(pythexec, cdir)
+                pid, address = server.run(file_path, (), cdir)
+                print("Forked debug session: ", pid, file_path)
+                self._session = (file_path, pythexec, None, pid)
+            else:
+                print("Executing: ", " ".join(argv))
+                proc, address = launch(argv, cwd=cdir)
+                self._session = (file_path, pythexec, proc, None)
+            self._debugger.attach(address=address)
         except Exception as e:
             self.setDebugging(False)
             raise
-        finally:
-            os.chdir(cwd)
 
     def debug(self, action=None):
         active_document = self.window.get_active_document()
@@ -0,0 +1,314 @@
+from gi.repository import GObject, Gtk, GdkPixbuf
+
+from .image_utils import get_pixbuf_from_file, VARIABLE_ICON
+
+
+class VariableRow(object):
+    """A variable shown in the tree, or the row to load the next page of its
+    siblings (start >= 0, "more..."); children is None until expanded, index
+    is the position among its siblings (kept when they are added/removed)"""
+
+    __slots__ = ('id', 'parent', 'index', 'name', 'value', 'handle', 'start',
+                 'expandable', 'children')
+
+    def __init__(self, id, handle, start=-1):
+        self.id = id
+        self.parent = None
+        self.index = 0
+        self.name = self.value = ""
+        self.handle = handle
+        self.start = start
+        self.expandable = False
+        self.children = None
+
+
+class VariablesModel(GObject.Object, Gtk.TreeModel):
+    """Lazy tree model of the variables (locals at the top level, globals
+    and children loaded a page at a time, when expanded).
+
+    Same columns as a TreeStore (icon, name, value, handle, start), but the
+    values are only read by the view for the rows shown, and the rows are
+    kept by handle: the same objects are updated at every stop.
+    Iterators hold the row id (they persist while the row is in the tree).
+    """
+
+    COLUMN_TYPES = (GdkPixbuf.Pixbuf.__gtype__, GObject.TYPE_STRING,
+                    GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_INT)
+
+    def __init__(self):
+        GObject.Object.__init__(self)
+        self.stamp = 1
+        self.roots = []
+        self.globals_row = None
+        self.rows = {}          # id: row (in the tree)
+        self.by_handle = {}     # handle: variable row (reused across stops)
+        self._last_id = 0
+
+    # changes (signals are emitted as a TreeStore would do)
+
+    def get_row(self, it):
+        return self.rows[it.user_data]
+
+    def clear(self):
+        self.globals_row = None
+        while self.roots:
+            self._forget(self.roots.pop())
+            self.row_deleted(Gtk.TreePath((len(self.roots), )))
+
+    def set_scopes(self, scopes):
+        "Show the locals page and the globals node (a full do_scopes)"
+        previous, self.by_handle = self.by_handle, {}
+        self.clear()
+        rows = []
+        for scope in scopes:
+            if scope['name'] == 'globals':
+                # globals are only inspected when expanded
+                row = self.globals_row = self._variable(scope['handle'],
+                                                        previous)
+                row.name, row.value = "Globals", "Global variables"
+                row.expandable = True
+                row.children = None
+                rows.append(row)
+            else:
+                # locals are shown at the top level
+                rows.extend(self._page_rows(scope, previous))
+        self._insert(None, rows, 0)
+
+    def patch_locals(self, diff):
+        "Update the top level rows in place (added, changed, removed names)"
+        names = dict((row.name, row) for row in self.roots
+                     if row.start < 0 and row is not self.globals_row)
+        for name in diff['removed']:
+            row = names.pop(name, None)
+            if row is not None:
+                self.remove(row)
+        for name, handle, vtype, val, expandable in diff['changed']:
+            row = names.get(name)
+            if row is None:
+                continue
+            if row.handle != handle:
+                self.by_handle.pop(row.handle, None)
+                row.handle = handle
+                self.by_handle[handle] = row
+            row.value = vtype + ': ' + val
+            self._reload(row, expandable)
+        if diff['added']:
+            # before the globals node (and the "more..." row)
+            index = len(self.roots)
+            while index and (self.roots[index - 1].start >= 0 or
+                             self.roots[index - 1] is self.globals_row):
+                index -= 1
+            page = {'handle': diff['handle'], 'start': 0, 'total': 0,
+                    'children': diff['added']}
+            self._insert(None, self._page_rows(page), index)
+        # the children loaded could have changed in place (same identity and
+        # short repr, i.e. an object attribute): load them again if expanded
+        for row in list(self.roots):
+            if row.children is not None:
+                self._reload(row, row.expandable)
+
+    def find(self, handle):
+        "Return an iterator for the row of a handle (None if not shown)"
+        row = self.by_handle.get(handle)
+        if row is None or row.id not in self.rows:
+            return None
+        return self._iter(row)
+
+    def find_more(self, handle, start):
+        "Return the row to load the page at start (None if not shown)"
+        parent = self.by_handle.get(handle)
+        siblings = self.roots if parent is None else parent.children
+        # the last row (the locals one is followed by the globals node)
+        for row in reversed((siblings or [])[-2:]):
+            if row.handle == handle and row.start == start:
+                return row
+
+    def add_page(self, parent, page, before=None):
+        "Add the rows of a do_inspect page under parent (None: top level)"
+        siblings = self.roots if parent is None else parent.children
+        if siblings is None:
+            siblings = parent.children = []
+        index = len(siblings) if before is None else before.index
+        self._insert(parent, self._page_rows(page), index)
+        if parent is not None and not parent.children:
+            # nothing to show: remove the expander
+            self.row_has_child_toggled(self._path(parent), self._iter(parent))
+
+    def remove(self, row):
+        siblings = self.roots if row.parent is None else row.parent.children
+        path = self._path(row)
+        del siblings[row.index]
+        self._renumber(siblings, row.index)
+        self._forget(row)
+        self.row_deleted(path)
+
+    def _page_rows(self, page, previous=None):
+        rows = []
+        for name, handle, vtype, val, expandable in page['children']:
+            row = self._variable(handle, previous)
+            row.name, row.value = name, vtype + ': ' + val
+            row.expandable = expandable
+            row.children = None
+            rows.append(row)
+        following = page['start'] + len(page['children'])
+        if following < page['total']:
+            self._last_id += 1
+            more = VariableRow(self._last_id, page['handle'], following)
+            more.name = "..."
+            more.value = "%d more..." % (page['total'] - following)
+            rows.append(more)
+        return rows
+
+    def _variable(self, handle, previous=None):
+        "Return the row for the handle (the one shown at the last stop)"
+        if handle is None:
+            # i.e. a set member: it can't be inspected nor found again
+            self._last_id += 1
+            return VariableRow(self._last_id, handle)
+        row = self.by_handle.get(handle)
+        if row is None and previous:
+            row = previous.pop(handle, None)
+        if row is None:
+            self._last_id += 1
+            row = VariableRow(self._last_id, handle)
+        self.by_handle[handle] = row
+        return row
+
+    def _insert(self, parent, rows, index):
+        siblings = self.roots if parent is None else parent.children
+        for row in rows:
+            row.parent = parent
+            siblings.insert(index, row)
+            self._renumber(siblings, index)
+            self.rows[row.id] = row
+            path, it = self._path(row), self._iter(row)
+            self.row_inserted(path, it)
+            if self._has_child(row):
+                self.row_has_child_toggled(path, it)
+            index += 1
+
+    def _renumber(self, siblings, start):
+        "Update the index of the rows moved by an insertion or removal"
+        for index in range(start, len(siblings)):
+            siblings[index].index = index
+
+    def _has_child(self, row):
+        # an expander is shown before the children are loaded (on expand)
+        if row.start >= 0:
+            return True     # "more..." row: expanded to get the next page
+        if row.children is None:
+            return row.expandable
+        return bool(row.children)
+
+    def _reload(self, row, expandable):
+        "The row changed: remove its children (inspected again on expand)"
+        had_child = self._has_child(row)
+        self._unload(row)
+        row.expandable = expandable
+        path, it = self._path(row), self._iter(row)
+        self.row_changed(path, it)
+        if had_child != self._has_child(row):
+            self.row_has_child_toggled(path, it)
+
+    def _unload(self, row):
+        "Remove the children (they will be inspected again if expanded)"
+        while row.children:
+            self.remove(row.children[-1])
+        row.children = None
+
+    def _forget(self, row):
+        self.rows.pop(row.id, None)
+        if self.by_handle.get(row.handle) is row:
+            del self.by_handle[row.handle]
+        for child in row.children or ():
+            self._forget(child)
+        row.children = None
+
+    def _iter(self, row):
+        it = Gtk.TreeIter()
+        it.stamp = self.stamp
+        it.user_data = row.id
+        return it
+
+    def _path(self, row):
+        indices = []
+        while row is not None:
+            indices.append(row.index)
+            row = row.parent
+        indices.reverse()
+        return Gtk.TreePath(tuple(indices))
+
+    # Gtk.TreeModel interface
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def do_get_column_type(self, index):
+        return self.COLUMN_TYPES[index]
+
+    def do_get_iter(self, path):
+        rows, row = self.roots, None
+        for index in path.get_indices():
+            if not rows or index >= len(rows):
+                return (False, None)
+            row = rows[index]
+            rows = row.children
+        if row is None:
+            return (False, None)
+        return (True, self._iter(row))
+
+    def do_get_path(self, it):
+        return self._path(self.get_row(it))
+
+    def do_get_value(self, it, column):
+        row = self.get_row(it)
+        if column == 0:
+            # the same pixbuf for every variable (loaded once)
+            return get_pixbuf_from_file(VARIABLE_ICON) if row.start < 0 else None
+        return (None, row.name, row.value, row.handle, row.start)[column]
+
+    def do_iter_next(self, it):
+        row = self.get_row(it)
+        siblings = self.roots if row.parent is None else row.parent.children
+        index = row.index + 1
+        if index >= len(siblings):
+            return False
+        it.user_data = siblings[index].id
+        return True
+
+    def do_iter_previous(self, it):
+        row = self.get_row(it)
+        siblings = self.roots if row.parent is None else row.parent.children
+        index = row.index - 1
+        if index < 0:
+            return False
+        it.user_data = siblings[index].id
+        return True
+
+    def do_iter_children(self, parent):
+        rows = self.roots if parent is None else self.get_row(parent).children
+        if not rows:
+            return (False, None)
+        return (True, self._iter(rows[0]))
+
+    def do_iter_has_child(self, it):
+        return self._has_child(self.get_row(it))
+
+    def do_iter_n_children(self, it):
+        rows = self.roots if it is None else self.get_row(it).children
+        return len(rows or ())
+
+    def do_iter_nth_child(self, parent, n):
+        rows = self.roots if parent is None else self.get_row(parent).children
+        if not rows or n >= len(rows):
+            return (False, None)
+        return (True, self._iter(rows[n]))
+
+    def do_iter_parent(self, child):
+        row = self.get_row(child)
+        if row.parent is None:
+            return (False, None)
+        return (True, self._iter(row.parent))